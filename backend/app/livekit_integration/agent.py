@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 
 from ..memory.memory_store import MemoryStore
 from ..llm.gemini_client import GeminiClient
+from ..multi_agent.agent_manager import DEFAULT_CONTEXT_TOKEN_BUDGET
 
 # Load environment variables
 load_dotenv()
@@ -22,12 +23,14 @@ class LiveKitAgent:
         room_name: str, 
         agent_name: str, 
         memory_store: MemoryStore,
-        llm_client: GeminiClient
+        llm_client: GeminiClient,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET
     ):
         self.room_name = room_name
         self.agent_name = agent_name
         self.memory_store = memory_store
         self.llm_client = llm_client
+        self.context_token_budget = context_token_budget
         
         # Initialize the LiveKit agent
         config = ChatAgentConfig(
@@ -62,17 +65,17 @@ class LiveKitAgent:
             
         logger.info(f"Received message from {sender_name}: {message}")
         
-        # Store the message in memory
-        self.memory_store.add_message(sender_name, message, is_user=True)
-        
-        # Get context from memory
-        context = self.memory_store.get_context_for_user(sender_name)
+        # Get context relevant to the message, then store it with the same embedding
+        context, embedding = await self.memory_store.aget_context_for_message(
+            sender_name, message, self.context_token_budget
+        )
+        await self.memory_store.aadd_message(sender_name, message, is_user=True, embedding=embedding)
         
         # Generate response using LLM
         response = await self.llm_client.generate_response(message, sender_name, context)
         
         # Store the AI response in memory
-        self.memory_store.add_message(sender_name, response, is_user=False)
+        await self.memory_store.aadd_message(sender_name, response, is_user=False)
         
         # Send response back to the room
         await self.send_message(response)
@@ -76,6 +76,22 @@ class GeminiClient:
 
         return "I'm sorry — I couldn't generate a response at this time."
 
+    def generate_text(self, prompt: str) -> str:
+        """
+        Blocking generation for a raw prompt, with the same retry policy.
+        Meant for background jobs (e.g. history compaction) running off the event loop.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._generate_and_extract(prompt)
+            except Exception:
+                attempt += 1
+                logger.exception("Gemini generation attempt %d failed", attempt)
+                if attempt > self._retry_attempts:
+                    raise
+                sleep(self._retry_backoff_seconds * attempt)
+
     def _generate_and_extract(self, prompt: str) -> str:
         """
         Blocking function that calls the SDK and extracts text robustly.
@@ -1,7 +1,9 @@
 import os
 import logging
 import pathlib
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
+import secrets
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Dict, List, Optional
@@ -16,8 +18,10 @@ print(f"GEMINI_API_KEY available: {'Yes' if os.getenv('GEMINI_API_KEY') else 'No
 
 from .livekit_integration.agent import LiveKitAgent
 from .memory.memory_store import MemoryStore
+from .memory.compaction import HistoryCompactor
+from .memory.bulk import parse_ndjson_line, to_ndjson
 from .llm.gemini_client import GeminiClient
-from .multi_agent.agent_manager import AgentManager
+from .multi_agent.agent_manager import AgentManager, DEFAULT_CONTEXT_TOKEN_BUDGET
 from .api import router as api_router
 
 # Configure logging
@@ -39,10 +43,45 @@ app.add_middleware(
 app.include_router(api_router, prefix="/api")
 
 # Initialize components
-memory_store = MemoryStore()
+memory_store = MemoryStore(
+    shared_index=os.getenv("MEMORY_SHARED_INDEX", "false").lower() == "true",
+    num_shards=int(os.getenv("MEMORY_INDEX_SHARDS", "1")),
+    max_resident_users=int(os.getenv("MEMORY_MAX_RESIDENT_USERS", "0")) or None,
+    max_resident_messages=int(os.getenv("MEMORY_MAX_RESIDENT_MESSAGES", "0")) or None,
+    durability=os.getenv("MEMORY_DURABILITY", "normal"),
+    approx_index_threshold=int(os.getenv("MEMORY_APPROX_INDEX_THRESHOLD", "20000")) or None,
+    approx_index_kind=os.getenv("MEMORY_APPROX_INDEX_KIND", "hnsw"),
+    approx_recall_target=float(os.getenv("MEMORY_APPROX_RECALL_TARGET", "0.95")),
+    vector_codec=os.getenv("MEMORY_VECTOR_CODEC", "flat"),
+    sq8_min_training_vectors=int(os.getenv("MEMORY_SQ8_MIN_TRAINING_VECTORS", "1000")),
+    rerank=os.getenv("MEMORY_RERANK", "false").lower() == "true",
+    dedupe_threshold=float(os.getenv("MEMORY_DEDUPE_THRESHOLD", "0")) or None,
+    dedupe_window=int(os.getenv("MEMORY_DEDUPE_WINDOW", "20")),
+    retrieval_mode=os.getenv("MEMORY_RETRIEVAL_MODE", "hybrid"),
+    retrieval_budget_ms=float(os.getenv("MEMORY_RETRIEVAL_BUDGET_MS", "150")) or None,
+    snapshot_interval_seconds=float(os.getenv("MEMORY_SNAPSHOT_INTERVAL_SECONDS", "300")) or None,
+    embedding_backend=os.getenv("MEMORY_EMBEDDING_BACKEND", "sentence-transformers"),
+    embedding_threads=int(os.getenv("MEMORY_EMBEDDING_THREADS", "0")) or None,
+    embedding_socket=os.getenv("MEMORY_EMBEDDING_SOCKET"),
+    embedding_check=os.getenv("MEMORY_EMBEDDING_CHECK", "false").lower() == "true",
+)
+context_token_budget = int(os.getenv("MEMORY_CONTEXT_TOKENS", str(DEFAULT_CONTEXT_TOKEN_BUDGET)))
 llm_client = GeminiClient()
 agent_manager = AgentManager(memory_store, llm_client)
 
+# Optional background folding of old turns into rolling summaries (0 disables)
+compactor = None
+if int(os.getenv("MEMORY_COMPACT_AFTER", "0")):
+    compactor = HistoryCompactor(
+        memory_store,
+        llm_client.generate_text,
+        trigger_messages=int(os.getenv("MEMORY_COMPACT_AFTER", "0")),
+        keep_recent=int(os.getenv("MEMORY_COMPACT_KEEP_RECENT", "100")),
+        batch_size=int(os.getenv("MEMORY_COMPACT_BATCH", "100")),
+        min_interval_seconds=float(os.getenv("MEMORY_COMPACT_MIN_INTERVAL_SECONDS", "5")),
+    )
+    compactor.start()
+
 # Store active connections
 active_connections: Dict[str, WebSocket] = {}
 active_agents: Dict[str, LiveKitAgent] = {}
@@ -65,6 +104,79 @@ class HandoffRequest(BaseModel):
 async def root():
     return {"message": "Percepta AI Chat Backend"}
 
+# Bulk import/export reads and writes every user's memory (and the stats name
+# users), so they are off unless explicitly enabled and then require
+# MEMORY_ADMIN_TOKEN in X-Admin-Token
+memory_bulk_api = os.getenv("MEMORY_BULK_API", "false").lower() == "true"
+memory_admin_token = os.getenv("MEMORY_ADMIN_TOKEN")
+if memory_bulk_api and not memory_admin_token:
+    logger.warning("MEMORY_BULK_API is enabled but MEMORY_ADMIN_TOKEN is not set; bulk endpoints stay disabled")
+
+def require_memory_admin(x_admin_token: Optional[str] = Header(None)):
+    if not memory_bulk_api or not memory_admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode("utf-8"), memory_admin_token.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.get("/memory/stats", dependencies=[Depends(require_memory_admin)])
+async def memory_stats():
+    """Embedding, database and vector index metrics"""
+    def collect() -> Dict:
+        # index_stats() waits for the store lock, so keep it off the event loop
+        return {
+            "embedding": memory_store.embedding_stats(),
+            "database": memory_store.db.stats(),
+            "index": memory_store.index_stats(),
+            "compaction": compactor.stats() if compactor else None,
+        }
+    
+    return await memory_store._run_in_executor(collect)
+
+@app.post("/memory/import", dependencies=[Depends(require_memory_admin)])
+async def import_memory(request: Request, chunk_size: int = 5000):
+    """Bulk-import an NDJSON request body, one message record per line"""
+    totals = {"messages": 0, "encoded": 0, "seconds": 0.0}
+    
+    async def flush(batch: List[Dict]):
+        stats = await memory_store.aimport_messages(batch, chunk_size=chunk_size)
+        for key in totals:
+            totals[key] += stats[key]
+    
+    batch: List[Dict] = []
+    buffer = b""
+    try:
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    batch.append(parse_ndjson_line(line.decode("utf-8")))
+            if len(batch) >= chunk_size:
+                await flush(batch)
+                batch = []
+        if buffer.strip():
+            batch.append(parse_ndjson_line(buffer.decode("utf-8")))
+        if batch:
+            await flush(batch)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid NDJSON after {totals['messages']} messages: {str(e)}")
+    
+    totals["per_second"] = totals["messages"] / max(totals["seconds"], 1e-9)
+    logger.info(f"Imported {totals['messages']} messages at {totals['per_second']:.0f} messages/s")
+    return totals
+
+@app.get("/memory/export", dependencies=[Depends(require_memory_admin)])
+async def export_memory(username: Optional[List[str]] = Query(None), embeddings: bool = False):
+    """Stream stored messages as NDJSON"""
+    records = memory_store.export_messages(usernames=username, include_embeddings=embeddings)
+    return StreamingResponse((to_ndjson(record) for record in records), media_type="application/x-ndjson")
+
+@app.on_event("shutdown")
+async def shutdown():
+    if compactor:
+        compactor.stop()
+    memory_store.close()
+
 @app.get("/agents")
 async def list_agents():
     """List all available agents"""
@@ -78,11 +190,15 @@ async def get_agent_response(request: AgentRequest, agent_name: str = "support-a
         # Use the agent name from the query param or default to support-agent
         
         # Initialize memory for this user if it doesn't exist
-        if not memory_store.user_exists(request.username):
-            memory_store.initialize_user(request.username)
+        if not await memory_store.auser_exists(request.username):
+            await memory_store.ainitialize_user(request.username)
         
-        # Get context from memory
-        context = memory_store.get_context_for_user(request.username)
+        # Get context relevant to the message, packed to the agent's token budget
+        agent = agent_manager.get_agent(agent_name)
+        token_budget = agent.context_token_budget if agent else context_token_budget
+        context, embedding = await memory_store.aget_context_for_message(
+            request.username, request.message, token_budget
+        )
         
         # Generate response using the agent
         response = await agent_manager.generate_agent_response(
@@ -93,8 +209,8 @@ async def get_agent_response(request: AgentRequest, agent_name: str = "support-a
         )
         
         # Store the message and response in memory
-        memory_store.add_message(request.username, request.message, is_user=True)
-        memory_store.add_message(request.username, response, is_user=False)
+        await memory_store.aadd_message(request.username, request.message, is_user=True, embedding=embedding)
+        await memory_store.aadd_message(request.username, response, is_user=False)
         
         return {"response": response, "agent": agent_name}
     except Exception as e:
@@ -131,8 +247,8 @@ async def create_room(request: RoomRequest):
         username = request.username
         
         # Initialize memory for this user if it doesn't exist
-        if not memory_store.user_exists(username):
-            memory_store.initialize_user(username)
+        if not await memory_store.auser_exists(username):
+            await memory_store.ainitialize_user(username)
         
         # Create a LiveKit token
         token = LiveKitAgent.create_token(room_name, username)
@@ -150,13 +266,15 @@ async def websocket_endpoint(websocket: WebSocket, username: str, room_name: str
     try:
         # Create and connect the AI agent to the room
         if room_name not in active_agents:
-            agent = LiveKitAgent(room_name, "ai-assistant", memory_store, llm_client)
+            agent = LiveKitAgent(
+                room_name, "ai-assistant", memory_store, llm_client, context_token_budget=context_token_budget
+            )
             await agent.connect()
             active_agents[room_name] = agent
             logger.info(f"AI agent joined room: {room_name}")
         
         # Send welcome message
-        context = memory_store.get_context_for_user(username)
+        context = await memory_store.abuild_context(username, context_token_budget)
         welcome_message = await llm_client.generate_response(
             f"Generate a welcome message for {username}. " + 
             (f"Context from previous conversations: {context}" if context else "This is a new user."),
@@ -174,17 +292,15 @@ async def websocket_endpoint(websocket: WebSocket, username: str, room_name: str
             data = await websocket.receive_json()
             message = data.get("message", "")
             
-            # Store the message in memory
-            memory_store.add_message(username, message, is_user=True)
-            
-            # Get context from memory
-            context = memory_store.get_context_for_user(username)
+            # Get context relevant to the message, then store it with the same embedding
+            context, embedding = await memory_store.aget_context_for_message(username, message, context_token_budget)
+            await memory_store.aadd_message(username, message, is_user=True, embedding=embedding)
             
             # Generate response using LLM
             response = await llm_client.generate_response(message, username, context)
             
             # Store the AI response in memory
-            memory_store.add_message(username, response, is_user=False)
+            await memory_store.aadd_message(username, response, is_user=False)
             
             # Send response back to user
             await websocket.send_json({
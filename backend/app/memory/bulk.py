@@ -0,0 +1,152 @@
+"""
+Streaming NDJSON import/export of conversation history.
+
+    python -m app.memory.bulk export --db memory.db > history.ndjson
+    python -m app.memory.bulk import --db memory.db history.ndjson
+    python -m app.memory.bulk import-legacy --db memory.db data/memory.db
+
+One JSON object per line: username, message, is_user, timestamp, is_summary
+and, with --embeddings, a base64 float32 "embedding" so the target skips encoding.
+"""
+import argparse
+import base64
+import json
+import logging
+import sqlite3
+import sys
+from typing import Dict, Iterable, Iterator, TextIO
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def encode_embedding(vector: np.ndarray) -> str:
+    """Base64 of a float32 vector, about a third the size of a JSON float list"""
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_embedding(value) -> np.ndarray:
+    """Vector from encode_embedding output or a plain list of floats"""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def to_ndjson(record: Dict) -> str:
+    """One export record as an NDJSON line"""
+    if record.get("embedding") is not None:
+        record = dict(record, embedding=encode_embedding(record["embedding"]))
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def parse_ndjson_line(line: str) -> Dict:
+    """One NDJSON line as an import record"""
+    record = json.loads(line)
+    if not isinstance(record, dict) or "username" not in record or "message" not in record:
+        raise ValueError("each record needs at least username and message")
+    if record.get("embedding") is not None:
+        record["embedding"] = decode_embedding(record["embedding"])
+    return record
+
+
+def read_ndjson(stream: Iterable[str]) -> Iterator[Dict]:
+    """Import records from NDJSON lines, skipping blank ones"""
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_ndjson_line(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {str(e)}") from e
+
+
+def iter_legacy_messages(db_path: str, chunk_size: int = 10000) -> Iterator[Dict]:
+    """Stream messages from the legacy data/memory.db used by the simple_server_* fallbacks"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute("SELECT username, message, is_user, timestamp FROM messages ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for username, message, is_user, timestamp in rows:
+                if username and message:
+                    yield {"username": username, "message": message, "is_user": bool(is_user), "timestamp": timestamp}
+    finally:
+        conn.close()
+
+
+def _log_progress(stats: Dict):
+    logger.info(
+        f"Imported {stats['messages']} messages ({stats['encoded']} encoded) "
+        f"in {stats['seconds']:.1f}s, {stats['per_second']:.0f} messages/s"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import/export of MemoryStore conversation history")
+    parser.add_argument("--db", default="memory.db", help="MemoryStore SQLite database")
+    parser.add_argument("--shared-index", action="store_true", help="open the store with shared index shards")
+    parser.add_argument("--index-shards", type=int, default=1)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subcommands.add_parser("export", help="write NDJSON to stdout or --output")
+    export_parser.add_argument("--output", help="file to write instead of stdout")
+    export_parser.add_argument("--user", action="append", dest="users", help="only this user (repeatable)")
+    export_parser.add_argument("--embeddings", action="store_true", help="include stored embeddings")
+
+    import_parser = subcommands.add_parser("import", help="read NDJSON from a file or stdin (-)")
+    import_parser.add_argument("input", nargs="?", default="-")
+    import_parser.add_argument("--chunk-size", type=int, default=5000)
+
+    legacy_parser = subcommands.add_parser("import-legacy", help="import a simple_server_* data/memory.db")
+    legacy_parser.add_argument("legacy_db", nargs="?", default="data/memory.db")
+    legacy_parser.add_argument("--chunk-size", type=int, default=5000)
+
+    args = parser.parse_args(argv)
+
+    # Imported late so --help works without loading the embedding model
+    from .memory_store import MemoryStore
+
+    store = MemoryStore(
+        db_path=args.db,
+        shared_index=args.shared_index,
+        num_shards=args.index_shards,
+        max_resident_users=1,
+        snapshot_interval_seconds=None,
+        approx_index_threshold=None,
+    )
+    try:
+        if args.command == "export":
+            out: TextIO = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+            count = 0
+            try:
+                for record in store.export_messages(usernames=args.users, include_embeddings=args.embeddings):
+                    out.write(to_ndjson(record))
+                    count += 1
+            finally:
+                if args.output:
+                    out.close()
+            logger.info(f"Exported {count} messages")
+        elif args.command == "import":
+            stream: TextIO = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+            try:
+                stats = store.import_messages(read_ndjson(stream), chunk_size=args.chunk_size, progress=_log_progress)
+            finally:
+                if args.input != "-":
+                    stream.close()
+            _log_progress(stats)
+        else:
+            stats = store.import_messages(
+                iter_legacy_messages(args.legacy_db), chunk_size=args.chunk_size, progress=_log_progress
+            )
+            _log_progress(stats)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from .context_buffer import render_line
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Summarize this conversation history between a user and an AI assistant.
+Keep facts about the user (name, preferences, goals, decisions), open questions and
+commitments the assistant made. Drop greetings and small talk. Write at most {max_words}
+words of plain prose in the third person.
+
+{previous}Conversation:
+{transcript}
+
+Summary:"""
+
+
+def build_summary_prompt(turns: List[Dict], previous_summary: Optional[str] = None, max_words: int = 200) -> str:
+    """Prompt folding a batch of turns (and the summary before them) into one summary"""
+    transcript = "".join(render_line(turn["message"], turn["is_user"]) for turn in turns)
+    previous = f"Summary of the conversation before this point:\n{previous_summary}\n\n" if previous_summary else ""
+    return SUMMARY_PROMPT.format(max_words=max_words, previous=previous, transcript=transcript)
+
+
+class HistoryCompactor:
+    """
+    Background job folding users' oldest turns into a rolling summary.
+    - A user is compacted once they have more than `trigger_messages` live turns;
+      the newest `keep_recent` turns always stay verbatim.
+    - Each run folds `batch_size` turns plus the previous summary into a new
+      summary, so a user only ever has one live summary covering all archived turns.
+    - `summarize(prompt) -> str` is a blocking LLM call (GeminiClient.generate_text).
+    - Rate limited: at most one LLM call per `min_interval_seconds`, at most
+      `max_batches_per_run` per pass, and only once the store has been idle for
+      `idle_seconds` so it never competes with interactive traffic.
+    """
+
+    def __init__(
+        self,
+        store,
+        summarize: Callable[[str], str],
+        trigger_messages: int = 500,
+        keep_recent: int = 100,
+        batch_size: int = 100,
+        interval_seconds: float = 60.0,
+        min_interval_seconds: float = 5.0,
+        idle_seconds: float = 2.0,
+        max_batches_per_run: int = 20,
+        summary_max_words: int = 200,
+    ):
+        if keep_recent >= trigger_messages:
+            raise ValueError("keep_recent must be smaller than trigger_messages")
+
+        self.store = store
+        self.summarize = summarize
+        self.trigger_messages = trigger_messages
+        self.keep_recent = keep_recent
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.min_interval_seconds = min_interval_seconds
+        self.idle_seconds = idle_seconds
+        self.max_batches_per_run = max_batches_per_run
+        self.summary_max_words = summary_max_words
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_call = 0.0
+        self._stats = {"runs": 0, "batches": 0, "messages_archived": 0, "errors": 0}
+
+    def start(self):
+        """Run compaction passes every `interval_seconds` on a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="memory-compaction", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop after the current batch"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict:
+        return dict(self._stats)
+
+    def run_once(self) -> int:
+        """One compaction pass over every eligible user, returning the batches folded"""
+        self._stats["runs"] += 1
+        batches = 0
+        for username in self.store.compaction_candidates(self.trigger_messages):
+            while batches < self.max_batches_per_run and not self._stop.is_set():
+                if not self._compact_batch(username):
+                    break
+                batches += 1
+        return batches
+
+    def _compact_batch(self, username: str) -> bool:
+        summary, turns = self.store.compaction_batch(username, self.keep_recent, self.batch_size)
+        if not turns:
+            return False
+
+        prompt = build_summary_prompt(turns, summary["message"] if summary else None, self.summary_max_words)
+        if not self._wait_for_turn():
+            return False
+        try:
+            text = self.summarize(prompt).strip()
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Error summarizing history for {username}: {str(e)}")
+            return False
+        if not text:
+            return False
+
+        folded_ids = [turn["id"] for turn in turns] + ([summary["id"]] if summary else [])
+        self.store.apply_compaction(username, text, folded_ids, turns[-1]["timestamp"])
+        self._stats["batches"] += 1
+        self._stats["messages_archived"] += len(turns)
+        return True
+
+    def _wait_for_turn(self) -> bool:
+        """Block until the rate limit and idle window allow another LLM call"""
+        while not self._stop.is_set():
+            now = time.monotonic()
+            wait = max(
+                self._last_call + self.min_interval_seconds - now,
+                self.store.last_activity + self.idle_seconds - now,
+            )
+            if wait <= 0:
+                self._last_call = now
+                return True
+            self._stop.wait(wait)
+        return False
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                batches = self.run_once()
+                if batches:
+                    logger.info(f"History compaction folded {batches} batches")
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Error compacting histories: {str(e)}")
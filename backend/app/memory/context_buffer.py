@@ -0,0 +1,88 @@
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, Optional, Tuple
+
+from .token_counter import LINE_OVERHEAD_TOKENS, pack_by_budget
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def render_line(message: str, is_user: bool, is_summary: bool = False) -> str:
+    """One "User: ..."/"Assistant: ..."/"Summary: ..." context line"""
+    if is_summary:
+        return f"Summary: {message}\n"
+    speaker = "User" if is_user else "Assistant"
+    return f"{speaker}: {message}\n"
+
+
+class ContextBuffer:
+    """
+    Ring buffer of a user's most recent context lines, rendered once on append.
+    - Appends are O(1); the oldest line falls off once `capacity` is reached.
+    - The user's rolling summary of compacted history, if any, always leads
+      the context and is budgeted before the recent lines.
+    - Joined contexts are memoized per size until the next append, since the
+      same context is requested several times per chat turn.
+    - Every method holds the buffer's own lock, so it can be read without any
+      outer lock while another thread appends.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self._lines = deque(maxlen=capacity)
+        self._tokens = deque(maxlen=capacity)
+        self._summary: Optional[Tuple[str, int]] = None
+        self._rendered: Dict = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def append(self, message: str, is_user: bool, tokens: int):
+        """Render and push a new message"""
+        self.append_line(render_line(message, is_user), tokens)
+
+    def append_line(self, line: str, tokens: int):
+        """Push an already rendered context line"""
+        with self._lock:
+            self._lines.append(line)
+            self._tokens.append(tokens)
+            self._rendered.clear()
+
+    def set_summary(self, summary: Optional[str], tokens: int = 0):
+        """Replace the leading summary line (None removes it)"""
+        with self._lock:
+            self._summary = None if summary is None else (render_line(summary, False, is_summary=True), tokens)
+            self._rendered.clear()
+
+    def extend(self, messages: Iterable[Dict]):
+        """Push stored message dicts, oldest first"""
+        for msg in messages:
+            self.append(msg["message"], msg["is_user"], msg["tokens"])
+
+    def render(self, k: int) -> str:
+        """The latest k lines joined, oldest first"""
+        key = ("k", k)
+        with self._lock:
+            if key not in self._rendered:
+                start = max(len(self._lines) - k, 0)
+                summary = self._summary[0] if self._summary else ""
+                self._rendered[key] = summary + "".join(islice(self._lines, start, None))
+            return self._rendered[key]
+
+    def pack(self, token_budget: int) -> str:
+        """The newest lines that fit `token_budget` tokens, joined oldest first"""
+        key = ("tokens", token_budget)
+        with self._lock:
+            if key not in self._rendered:
+                summary = ""
+                if self._summary and self._summary[1] + LINE_OVERHEAD_TOKENS <= token_budget:
+                    summary = self._summary[0]
+                    token_budget -= self._summary[1] + LINE_OVERHEAD_TOKENS
+                newest_first = zip(reversed(self._lines), reversed(self._tokens))
+                self._rendered[key] = summary + "".join(reversed(pack_by_budget(newest_first, token_budget)))
+            return self._rendered[key]
@@ -0,0 +1,194 @@
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("sentence-transformers", "onnx", "onnx-int8", "remote")
+
+# Sentences used when comparing a backend against the reference model
+EQUIVALENCE_SAMPLE = [
+    "Hi! My name is Priya and I'm looking for a vegetarian lasagna recipe.",
+    "Can you explain how a hash map handles collisions?",
+    "I prefer short answers, please.",
+    "What's the weather usually like in Lisbon in October?",
+    "Thanks, that fixed the segmentation fault in my C program.",
+    "Write a haiku about autumn leaves and a quiet train station.",
+    "Remind me what we decided about the database migration yesterday.",
+    "ok",
+    "The quarterly revenue grew 12% year over year, driven by subscriptions.",
+    "Why does my Python asyncio task never finish when I call run_until_complete?",
+]
+
+
+def _hub_repo(model_name: str) -> str:
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+
+class EmbeddingBackend:
+    """Encodes texts into float32 sentence embeddings (rows of a (n, dim) array)"""
+
+    name = "base"
+    model_name = ""
+    dim = 0
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self):
+        """Release connections or sessions held by the backend"""
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """Reference PyTorch implementation via sentence-transformers"""
+
+    name = "sentence-transformers"
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        # Imported here so other backends never pay for loading torch
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True).astype(np.float32)
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    The same sentence-transformers model run with ONNX Runtime on CPU.
+    - Uses the ONNX export published with the model on the Hugging Face hub
+      and the fast Rust tokenizer; neither torch nor transformers is loaded.
+    - Mean pooling over the attention mask plus L2 normalization reproduce the
+      model's Pooling and Normalize modules.
+    - quantize=True applies dynamic int8 quantization to the weights once and
+      caches the result next to the downloaded model.
+    - `threads` bounds intra-op parallelism, useful with several workers per host.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        quantize: bool = False,
+        threads: Optional[int] = None,
+        max_seq_length: int = 256,
+    ):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        self.name = "onnx-int8" if quantize else "onnx"
+        self.model_name = model_name
+        repo = _hub_repo(model_name)
+        model_path = hf_hub_download(repo, "onnx/model.onnx")
+        if quantize:
+            model_path = self._quantized(model_path)
+
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(repo, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    @staticmethod
+    def _quantized(model_path: str) -> str:
+        quantized_path = os.path.join(os.path.dirname(model_path), "model_int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"Quantizing {model_path} to int8")
+            tmp_path = f"{quantized_path}.tmp"
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+        return quantized_path
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            out[start:start + len(encodings)] = pooled / np.maximum(
+                np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12
+            )
+        return out
+
+
+def create_backend(kind: str = "sentence-transformers", model_name: str = "all-MiniLM-L6-v2", **kwargs) -> EmbeddingBackend:
+    """Instantiate an embedding backend by name"""
+    if kind == "sentence-transformers":
+        return SentenceTransformerBackend(model_name)
+    if kind in ("onnx", "onnx-int8"):
+        return OnnxBackend(model_name, quantize=kind == "onnx-int8", **kwargs)
+    if kind == "remote":
+        # The model is loaded by the embedding server process, not here
+        from .embedding_server import RemoteBackend
+
+        return RemoteBackend(**kwargs)
+    raise ValueError(f"embedding backend must be one of {BACKENDS}")
+
+
+def check_equivalence(
+    backend: EmbeddingBackend,
+    reference: Optional[EmbeddingBackend] = None,
+    texts: Optional[List[str]] = None,
+    model_name: Optional[str] = None,
+) -> Dict:
+    """
+    Cosine agreement between a backend and the reference model on sample texts,
+    plus each side's encode time. Vectors from both must be interchangeable
+    in one index, so the minimum cosine is what matters. The reference is the
+    sentence-transformers build of `model_name` (default: the backend's model).
+    """
+    reference = reference or SentenceTransformerBackend(model_name or backend.model_name or "all-MiniLM-L6-v2")
+    texts = texts or EQUIVALENCE_SAMPLE
+
+    timings = {}
+    vectors = {}
+    for label, model in (("backend", backend), ("reference", reference)):
+        model.encode(texts[:1])  # warm up before timing
+        started = time.perf_counter()
+        vectors[label] = model.encode(texts, batch_size=len(texts))
+        timings[label] = (time.perf_counter() - started) * 1000.0
+
+    a, b = vectors["backend"], vectors["reference"]
+    cosine = (a * b).sum(axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+    return {
+        "backend": backend.name,
+        "texts": len(texts),
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "backend_ms": timings["backend"],
+        "reference_ms": timings["reference"],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare an embedding backend against the reference model")
+    parser.add_argument("--backend", default="onnx-int8", choices=BACKENDS)
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    args = parser.parse_args()
+    print(check_equivalence(create_backend(args.backend, args.model), model_name=args.model))
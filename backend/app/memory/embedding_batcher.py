@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching front end for an embedding model.
+    - Callers submit single strings and get a concurrent.futures.Future back.
+    - A worker thread gathers requests for up to `max_wait_ms` (or until
+      `max_batch_size` is reached) and encodes them in one forward pass.
+    - Queue depth and batch-size metrics are available from `stats()`.
+    """
+
+    def __init__(
+        self,
+        encode_batch: Callable[[List[str]], np.ndarray],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        self._encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._largest_batch = 0
+        self._encode_seconds = 0.0
+        self._batch_size_histogram: Dict[int, int] = {}
+
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """Queue a string for encoding and return a future for its float32 vector"""
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """Encode a single string, blocking until its batch has run"""
+        return self.submit(text).result()
+
+    def encode_many(self, texts: Sequence[str]) -> np.ndarray:
+        """Encode several strings through the shared queue and stack the results"""
+        futures = [self.submit(text) for text in texts]
+        return np.vstack([future.result() for future in futures]) if futures else np.empty((0, 0), dtype=np.float32)
+
+    def stats(self) -> Dict:
+        """Queue depth and batching metrics"""
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "requests": self._requests,
+                "batches": self._batches,
+                "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "largest_batch": self._largest_batch,
+                "encode_seconds": self._encode_seconds,
+                "batch_size_histogram": dict(sorted(self._batch_size_histogram.items())),
+            }
+
+    def close(self):
+        """Stop the worker once the queued requests have been encoded"""
+        if self._worker.is_alive():
+            self._queue.put(_STOP)
+            self._worker.join()
+
+    def _collect(self, first: Tuple[str, Future]) -> Tuple[List[Tuple[str, Future]], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch, stopping = self._collect(item)
+
+            # Skip requests whose caller has already given up
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                vectors = np.asarray(self._encode_batch([text for text, _ in batch]), dtype=np.float32)
+            except Exception as e:
+                logger.error(f"Error encoding batch of {len(batch)} texts: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - started
+
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+            self._record(len(batch), elapsed)
+
+    def _record(self, batch_size: int, elapsed: float):
+        # Histogram buckets are powers of two: 1, 2, 4, 8, ...
+        bucket = 1 << (batch_size - 1).bit_length()
+        with self._stats_lock:
+            self._requests += batch_size
+            self._batches += 1
+            self._largest_batch = max(self._largest_batch, batch_size)
+            self._encode_seconds += elapsed
+            self._batch_size_histogram[bucket] = self._batch_size_histogram.get(bucket, 0) + 1
@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+# Models with an uncased WordPiece tokenizer, for which case never changes the embedding
+UNCASED_MODELS = ("all-MiniLM-L6-v2", "all-MiniLM-L12-v2")
+
+
+def is_uncased(model_name: str) -> bool:
+    """Whether a model's embeddings ignore case, so cache keys may fold it"""
+    return model_name.split("/")[-1] in UNCASED_MODELS
+
+
+def normalize_text(text: str, case_fold: bool = True) -> str:
+    """Normalize text for cache lookups"""
+    # Whitespace differences never change the embedding; case only doesn't for uncased models
+    text = " ".join(text.split())
+    return text.lower() if case_fold else text
+
+
+def content_hash(text: str, case_fold: bool = True) -> str:
+    """Hash of the normalized text, used as the embedding cache key"""
+    key = normalize_text(text, case_fold)
+    if not case_fold:
+        # Never equal to a case-folded key already stored in messages.content_hash
+        key = f"cased:{key}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of float32 embeddings keyed by content hash.
+    - Bounded by `max_entries`; the least recently used vector is dropped first.
+    - Hit, miss and eviction counters are available from `stats()`.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached vector for a key, counting the hit or miss"""
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: str, vector: np.ndarray):
+        """Store a vector, evicting the least recently used entries if full"""
+        if self.max_entries <= 0:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        """Cache size and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within one process
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingMatrix:
+    """
+    Append-only float32 matrix file, memory-mapped for reads.
+    - Row n of the file is the vector stored at offset n; SQLite only keeps offsets.
+    - Appends take an exclusive file lock so worker processes sharing the file
+      always get distinct offsets.
+    - Reads go through a read-only np.memmap that is remapped when the file has
+      grown, so the page cache is shared by every process using the file.
+    - Without `fsync`, appended rows reach disk on flush(); the store calls it
+      before every SQLite commit that references their offsets.
+    """
+
+    def __init__(self, path: str, vector_dim: int, fsync: bool = False):
+        self.path = path
+        self.vector_dim = vector_dim
+        self.fsync = fsync
+        self._row_bytes = vector_dim * np.dtype(np.float32).itemsize
+        self._lock = threading.Lock()
+        self._map: Optional[np.memmap] = None
+        self._dirty = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def __len__(self) -> int:
+        return os.fstat(self._fd).st_size // self._row_bytes
+
+    def append(self, vectors: np.ndarray) -> int:
+        """Append rows and return the offset of the first one"""
+        data = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.vector_dim).tobytes()
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(self._fd).st_size
+                if size % self._row_bytes:
+                    # Drop a partial row left behind by a crash mid-append
+                    size -= size % self._row_bytes
+                    os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, data, size)
+                if self.fsync:
+                    os.fsync(self._fd)
+                else:
+                    self._dirty = True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return size // self._row_bytes
+
+    def view(self, min_rows: int = 0) -> np.ndarray:
+        """Memory-mapped (rows, dim) view covering at least `min_rows` rows"""
+        with self._lock:
+            if self._map is None or len(self._map) < max(min_rows, 1):
+                rows = len(self)
+                if rows == 0:
+                    return np.empty((0, self.vector_dim), dtype=np.float32)
+                self._map = np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, self.vector_dim))
+            return self._map
+
+    def read(self, offsets: np.ndarray) -> np.ndarray:
+        """Copy the rows at the given offsets into a new array"""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(offsets) == 0:
+            return np.empty((0, self.vector_dim), dtype=np.float32)
+        matrix = self.view(int(offsets.max()) + 1)
+        # Contiguous runs (the common case at boot) are sliced without a gather
+        if offsets[-1] - offsets[0] == len(offsets) - 1 and np.all(np.diff(offsets) == 1):
+            return np.array(matrix[offsets[0]:offsets[-1] + 1])
+        return matrix[offsets]
+
+    def flush(self):
+        """Force appended rows to disk (nothing to do if none were appended since the last flush)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            # Cleared first, so rows appended during the fsync are synced by the next flush
+            self._dirty = False
+        os.fsync(self._fd)
+
+    def close(self):
+        """Release the memory map and file descriptor"""
+        with self._lock:
+            self._map = None
+            os.close(self._fd)
@@ -0,0 +1,241 @@
+"""
+Shared embedding model process for multi-worker deployments.
+
+    python -m app.memory.embedding_server --backend onnx-int8 --socket /tmp/percepta-embeddings.sock
+
+Workers started with MEMORY_EMBEDDING_BACKEND=remote (and MEMORY_EMBEDDING_SOCKET
+if the path differs) never load the model themselves; texts from all of them
+are gathered into the same batches here.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .embedding_backends import BACKENDS, EmbeddingBackend, create_backend
+from .embedding_batcher import EmbeddingBatcher
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/percepta-embeddings.sock"
+
+# Frames are a 4-byte big-endian length followed by the payload
+_FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+
+def send_frame(sock: socket.socket, payload: bytes):
+    sock.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    (length,) = _FRAME_HEADER.unpack(_recv_exact(sock, _FRAME_HEADER.size))
+    if length > MAX_FRAME_BYTES:
+        raise ConnectionError(f"frame of {length} bytes exceeds {MAX_FRAME_BYTES}")
+    return _recv_exact(sock, length)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("embedding server connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.embedding_server.handle_connection(self.request)
+
+
+class EmbeddingServer:
+    """
+    Serves one embedding model to every worker on the host over a Unix socket.
+    - Each connection gets a thread; texts from all connections go through one
+      EmbeddingBatcher, so concurrent workers share forward passes.
+    - A request is a JSON frame {"texts": [...]}; the reply is a JSON header
+      frame ({"dim", "name", "model", "count"} or {"error"}) followed by a frame of
+      count x dim little-endian float32 values. Empty texts only fetch the header.
+    """
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        backend: str = "sentence-transformers",
+        model_name: str = "all-MiniLM-L6-v2",
+        threads: Optional[int] = None,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        options = {"threads": threads} if backend != "sentence-transformers" else {}
+        self.model = create_backend(backend, model_name, **options)
+        self.batcher = EmbeddingBatcher(
+            lambda texts: self.model.encode(texts, batch_size=len(texts)),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+        )
+        self.socket_path = socket_path
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+
+    def serve_forever(self):
+        """Listen on the socket until shutdown() is called"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, _Handler)
+        self._server.daemon_threads = True
+        self._server.embedding_server = self
+        logger.info(f"Serving {self.model.name} ({self.model.dim}-d) embeddings on {self.socket_path}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.batcher.close()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+    def stats(self) -> Dict:
+        return self.batcher.stats()
+
+    def handle_connection(self, conn: socket.socket):
+        """Answer requests on one worker connection until it closes"""
+        while True:
+            try:
+                request = json.loads(recv_frame(conn))
+            except (ConnectionError, OSError):
+                return
+
+            texts = request.get("texts") or []
+            try:
+                vectors = self.batcher.encode_many(texts) if texts else None
+            except Exception as e:
+                send_frame(conn, json.dumps({"error": str(e)}).encode("utf-8"))
+                continue
+
+            header = {"dim": self.model.dim, "name": self.model.name, "model": self.model.model_name, "count": len(texts)}
+            send_frame(conn, json.dumps(header).encode("utf-8"))
+            if vectors is not None:
+                send_frame(conn, np.asarray(vectors, dtype="<f4").tobytes())
+
+
+class RemoteBackend(EmbeddingBackend):
+    """
+    Embedding backend that calls an EmbeddingServer instead of loading a model.
+    - One connection per process, guarded by a lock and reopened once after an error.
+    - Waits up to `connect_timeout_seconds` for the server, so workers can start
+      while it is still loading the model.
+    """
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        timeout_seconds: float = 30.0,
+        connect_timeout_seconds: float = 60.0,
+    ):
+        self.socket_path = socket_path
+        self.timeout_seconds = timeout_seconds
+        self.connect_timeout_seconds = connect_timeout_seconds
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+
+        header, _ = self._request([])
+        self.dim = header["dim"]
+        self.name = f"remote:{header['name']}"
+        self.model_name = header.get("model", "")
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), max(batch_size, 1)):
+            _, vectors = self._request(texts[start:start + batch_size])
+            out[start:start + len(vectors)] = vectors
+        return out
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _request(self, texts: List[str]):
+        payload = json.dumps({"texts": texts}, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    send_frame(self._sock, payload)
+                    header = json.loads(recv_frame(self._sock))
+                    if "error" in header:
+                        raise RuntimeError(f"embedding server error: {header['error']}")
+                    vectors = None
+                    if header["count"]:
+                        vectors = np.frombuffer(recv_frame(self._sock), dtype="<f4")
+                        vectors = vectors.reshape(header["count"], header["dim"])
+                    return header, vectors
+                except (ConnectionError, OSError) as e:
+                    self._disconnect()
+                    if attempt:
+                        raise
+                    logger.warning(f"Embedding server connection failed, reconnecting: {str(e)}")
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout_seconds
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout_seconds)
+            try:
+                sock.connect(self.socket_path)
+                self._sock = sock
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve one embedding model to every worker on this host")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--backend", default="sentence-transformers", choices=[b for b in BACKENDS if b != "remote"])
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    server = EmbeddingServer(
+        socket_path=args.socket,
+        backend=args.backend,
+        model_name=args.model,
+        threads=args.threads,
+        max_batch_size=args.batch_size,
+        max_wait_ms=args.batch_wait_ms,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,322 @@
 import os
+import asyncio
+import hashlib
 import logging
+import threading
+import time
 import numpy as np
-import faiss
 import json
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime
-from sentence_transformers import SentenceTransformer
-import sqlite3
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import groupby, islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+
+from .context_buffer import ContextBuffer, render_line
+from .embedding_backends import check_equivalence, create_backend
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import EmbeddingCache, content_hash, is_uncased
+from .embedding_matrix import EmbeddingMatrix
+from .message_table import MessageTable
+from .sqlite_writer import SQLiteWriter
+from .token_counter import count_tokens, pack_by_budget
+from .snapshots import SnapshotDirectory, read_index_file, serialize_index, write_index_file
+from .vector_index import SQ8_MIN_TRAINING_VECTORS, VectorIndex, build_approximate_index, bytes_per_vector, shard_for
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RETRIEVAL_MODES = ("recency", "semantic", "hybrid")
+
+
+def _is_recency(query: Optional[str], mode: Optional[str]) -> bool:
+    """Whether a retrieval reduces to the latest messages (validates `mode`)"""
+    if mode is not None and mode not in RETRIEVAL_MODES:
+        raise ValueError(f"mode must be one of {RETRIEVAL_MODES}")
+    return not query or mode == "recency"
+
+
+def _chronological_key(msg: Dict) -> Tuple[bool, int]:
+    """Sort key placing a user's rolling summary before the turns it precedes"""
+    return (not msg["is_summary"], msg["id"])
+
+
+def _user_key(username: str) -> str:
+    """Filesystem-safe key for a username"""
+    return hashlib.sha1(username.encode("utf-8")).hexdigest()
+
+
+def _parse_db_timestamp(value: Optional[str]) -> float:
+    """Epoch seconds for a SQLite CURRENT_TIMESTAMP (UTC) value"""
+    if not value:
+        return 0.0
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
 class MemoryStore:
-    def __init__(self, db_path: str = "memory.db", vector_dim: int = 384):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(
+        self,
+        db_path: str = "memory.db",
+        vector_dim: int = 384,
+        shared_index: bool = False,
+        num_shards: int = 1,
+        max_resident_users: Optional[int] = None,
+        max_resident_messages: Optional[int] = None,
+        embedding_batch_size: int = 64,
+        embedding_batch_wait_ms: float = 5.0,
+        durability: str = "normal",
+        commit_interval_ms: float = 50.0,
+        commit_max_rows: int = 256,
+        max_workers: int = 8,
+        embedding_cache_size: int = 10000,
+        persistent_embedding_cache: bool = True,
+        vector_dir: Optional[str] = None,
+        snapshot_dir: Optional[str] = None,
+        snapshot_interval_seconds: Optional[float] = 300.0,
+        approx_index_threshold: Optional[int] = 20000,
+        approx_index_kind: str = "hnsw",
+        approx_recall_target: float = 0.95,
+        vector_codec: str = "flat",
+        sq8_min_training_vectors: int = SQ8_MIN_TRAINING_VECTORS,
+        rerank: bool = False,
+        rerank_factor: int = 4,
+        dedupe_threshold: Optional[float] = None,
+        dedupe_window: int = 20,
+        hybrid_semantic_weight: float = 0.7,
+        recency_half_life_hours: float = 72.0,
+        hybrid_candidates: int = 50,
+        retrieval_mode: str = "hybrid",
+        retrieval_budget_ms: Optional[float] = 150.0,
+        context_buffer_size: int = 64,
+        embedding_backend: str = "sentence-transformers",
+        embedding_model: str = "all-MiniLM-L6-v2",
+        embedding_threads: Optional[int] = None,
+        embedding_socket: Optional[str] = None,
+        embedding_check: bool = False,
+        embedding_check_min_cosine: float = 0.98,
+    ):
+        # sentence-transformers (PyTorch), ONNX Runtime (optionally int8-quantized)
+        # or a shared embedding server process
+        backend_options = {}
+        if embedding_backend == "remote":
+            backend_options = {"socket_path": embedding_socket} if embedding_socket else {}
+        elif embedding_backend != "sentence-transformers":
+            backend_options = {"threads": embedding_threads}
+        self.model = create_backend(embedding_backend, embedding_model, **backend_options)
+        if self.model.dim != vector_dim:
+            raise ValueError(f"{embedding_backend} produces {self.model.dim}-d vectors, expected {vector_dim}")
+        self.embedding_equivalence: Optional[Dict] = None
+        if embedding_check and embedding_backend not in ("sentence-transformers", "remote"):
+            # Stored vectors must stay interchangeable with the reference model's
+            self.embedding_equivalence = check_equivalence(self.model, model_name=embedding_model)
+            logger.info(f"Embedding backend equivalence: {self.embedding_equivalence}")
+            if self.embedding_equivalence["min_cosine"] < embedding_check_min_cosine:
+                raise ValueError(
+                    f"{embedding_backend} embeddings disagree with the reference model "
+                    f"(min cosine {self.embedding_equivalence['min_cosine']:.4f} < {embedding_check_min_cosine})"
+                )
+        # Concurrent encode requests are gathered into one forward pass
+        self.embedder = EmbeddingBatcher(
+            self._encode_batch,
+            max_batch_size=embedding_batch_size,
+            max_wait_ms=embedding_batch_wait_ms,
+        )
+        # Repeated texts (welcome messages, "thanks", ...) skip the model entirely;
+        # keys fold case only when the loaded model ignores it
+        self.embedding_cache = EmbeddingCache(max_entries=embedding_cache_size)
+        self.case_fold = is_uncased(self.model.model_name)
+        self.persistent_embedding_cache = persistent_embedding_cache
+        self._persistent_cache_hits = 0
         self.vector_dim = vector_dim
         self.db_path = db_path
-        self.user_indices: Dict[str, faiss.IndexFlatL2] = {}
-        self.user_messages: Dict[str, List[Dict]] = {}
+        # Long-lived WAL connection with group commit
+        self.db = SQLiteWriter(
+            db_path,
+            durability=durability,
+            commit_interval_ms=commit_interval_ms,
+            commit_max_rows=commit_max_rows,
+        )
+        # Bounded pool for the awaitable API, guarded in-memory state
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.RLock()
+        
+        # Heavy users are moved to HNSW/IVF indices by a background worker
+        self.approx_index_threshold = approx_index_threshold
+        self.approx_index_kind = approx_index_kind
+        self.approx_recall_target = approx_recall_target
+        self.promotion_reports: Dict[str, Dict] = {}
+        self._promoting: Set[str] = set()
+        self._maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-maintenance")
+        
+        # Resident users in least-recently-used order, loaded on first access
+        self.user_messages: "OrderedDict[str, MessageTable]" = OrderedDict()
+        self.max_resident_users = max_resident_users
+        self.max_resident_messages = max_resident_messages
+        self._resident_messages = 0
+        # Pre-rendered recent context lines per resident user
+        self.context_buffer_size = context_buffer_size
+        self.context_buffers: Dict[str, ContextBuffer] = {}
+        # Monotonic time of the last user-facing call; background compaction waits for idle periods
+        self.last_activity = time.monotonic()
         
         # Initialize database
         self._initialize_db()
         
-        # Load existing users from database
-        self._load_existing_users()
+        # Append-only, memory-mapped embedding matrix per shard
+        self.vector_dir = vector_dir or os.path.splitext(db_path)[0] + "_vectors"
+        self.vector_files = [
+            EmbeddingMatrix(
+                os.path.join(self.vector_dir, f"shard_{shard}.f32"),
+                vector_dim,
+                fsync=durability == "full",
+            )
+            for shard in range(num_shards)
+        ]
+        if durability == "normal":
+            # Rows must never be committed pointing at vectors still only in the page cache
+            self.db.before_commit = self._sync_vector_files
+        self._recover_lost_vectors()
+        self._migrate_blob_embeddings()
+        
+        # Optionally compressed FAISS storage; the matrix files keep float32 for re-ranking.
+        # sq8 is trained on stored vectors once there are enough (fp16 until then)
+        training_vectors = self._training_sample() if vector_codec == "sq8" else None
+        self.vector_index = VectorIndex(
+            vector_dim,
+            shared=shared_index,
+            num_shards=num_shards,
+            codec=vector_codec,
+            training_vectors=training_vectors,
+            min_training_vectors=sq8_min_training_vectors,
+        )
+        self._codec_training = False
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        
+        # Near-duplicates of a recent message are stored as references without a vector
+        self.dedupe_threshold = dedupe_threshold
+        self.dedupe_window = dedupe_window
+        self._duplicates_suppressed = 0
+        
+        # Hybrid retrieval: score = w * similarity + (1 - w) * 0.5 ** (age / half-life)
+        self.hybrid_semantic_weight = hybrid_semantic_weight
+        self.recency_half_life_seconds = recency_half_life_hours * 3600.0
+        self.hybrid_candidates = hybrid_candidates
+        
+        # Context for an incoming chat message, falling back to recency past the budget
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval_mode must be one of {RETRIEVAL_MODES}")
+        self.retrieval_mode = retrieval_mode
+        self.retrieval_budget_seconds = retrieval_budget_ms / 1000.0 if retrieval_budget_ms else None
+        self._retrieval_fallbacks = 0
+        self.codec_recall: Optional[float] = None
+        if vector_codec != "flat":
+            sample = training_vectors if training_vectors is not None else self._training_sample()
+            if len(sample):
+                self.codec_recall = self.vector_index.measure_recall(sample)
+                logger.info(
+                    f"Vector codec {self.vector_index.storage_codec}: recall@10 vs float32 = {self.codec_recall:.3f}"
+                )
+        
+        # FAISS snapshots: boot loads the latest one and replays only newer rows
+        self.snapshots = SnapshotDirectory(snapshot_dir or os.path.splitext(db_path)[0] + "_snapshots")
+        self._last_indexed_id = 0
+        self._user_snapshot_ids: Dict[str, int] = {}
+        # Latest shared generation: its directory and (index version, meta) per file
+        self._generation_path: Optional[str] = None
+        self._generation_files: Dict[str, Tuple[int, Dict]] = {}
+        
+        # Shared shards hold every user's vectors, everything else is loaded lazily
+        if self.vector_index.shared:
+            self._load_shared_vectors(*self._restore_shared_snapshot())
+        
+        self._snapshot_stop = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_interval_seconds:
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_loop, args=(snapshot_interval_seconds,), name="memory-snapshots", daemon=True
+            )
+            self._snapshot_thread.start()
+    
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        """Encode a batch of texts with the sentence transformer"""
+        return self.model.encode(texts, batch_size=len(texts))
+    
+    def embed(self, text: str) -> Future:
+        """Return a future for a text's vector, served from the cache when possible"""
+        key = self._content_hash(text)
+        vector = self._lookup_cached_embedding(key)
+        if vector is not None:
+            future: Future = Future()
+            future.set_result(vector)
+            return future
+        
+        future = self.embedder.submit(text)
+        future.add_done_callback(
+            lambda done: self.embedding_cache.put(key, done.result()) if done.exception() is None else None
+        )
+        return future
+    
+    def _content_hash(self, text: str) -> str:
+        return content_hash(text, case_fold=self.case_fold)
+    
+    def _lookup_cached_embedding(self, key: str) -> Optional[np.ndarray]:
+        """Look a content hash up in the LRU cache, then in stored messages"""
+        vector = self.embedding_cache.get(key)
+        if vector is not None or not self.persistent_embedding_cache:
+            return vector
+        
+        rows = self.db.query(
+            "SELECT embedding, vector_shard, vector_offset FROM messages "
+            "WHERE content_hash = ? AND (embedding IS NOT NULL OR vector_offset IS NOT NULL) LIMIT 1",
+            (key,)
+        )
+        if not rows:
+            return None
+        
+        vector = self._read_vectors(rows)[0]
+        self.embedding_cache.put(key, vector)
+        self._persistent_cache_hits += 1
+        return vector
+    
+    def embedding_stats(self) -> Dict:
+        """Queue depth, batch-size and cache metrics of the embedding service"""
+        stats = self.embedder.stats()
+        stats["backend"] = self.model.name
+        stats["equivalence"] = self.embedding_equivalence
+        stats["cache"] = self.embedding_cache.stats()
+        stats["cache"]["persistent_hits"] = self._persistent_cache_hits
+        return stats
+    
+    def close(self):
+        """Stop background workers, write a final snapshot and commit pending writes"""
+        self._snapshot_stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        self._executor.shutdown(wait=True)
+        self._maintenance_executor.shutdown(wait=True)
+        self.write_snapshots()
+        self.embedder.close()
+        self.model.close()
+        self.db.close()
+        for vector_file in self.vector_files:
+            vector_file.close()
     
     def _initialize_db(self):
         """Initialize the SQLite database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Create tables if they don't exist
-        cursor.execute('''
+        self.db.execute('''
         CREATE TABLE IF NOT EXISTS users (
             username TEXT PRIMARY KEY,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
         
-        cursor.execute('''
+        self.db.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT,
@@ -51,133 +328,1280 @@ class MemoryStore:
         )
         ''')
         
-        conn.commit()
-        conn.close()
+        # Columns added after the original schema
+        self._ensure_column("messages", "content_hash", "TEXT")
+        self._ensure_column("messages", "vector_shard", "INTEGER")
+        self._ensure_column("messages", "vector_offset", "INTEGER")
+        self._ensure_column("messages", "token_count", "INTEGER")
+        # Rolling summaries, and the summary each archived row was folded into
+        self._ensure_column("messages", "is_summary", "INTEGER NOT NULL DEFAULT 0")
+        self._ensure_column("messages", "compacted_into", "INTEGER")
+        self._ensure_column("messages", "duplicate_of", "INTEGER")
+        
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_username_id ON messages (username, id)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_content_hash ON messages (content_hash)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_compacted_into ON messages (compacted_into)"
+        )
+        
+        self.db.flush()
+    
+    def _ensure_column(self, table: str, column: str, declaration: str):
+        """Add a column to an existing table if it is missing"""
+        columns = {row[1] for row in self.db.query(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    
+    def _store_vectors(self, username: str, vectors: np.ndarray) -> Tuple[int, int]:
+        """Append vectors to the user's matrix shard, returning (shard, first offset)"""
+        shard = shard_for(username, len(self.vector_files))
+        return shard, self.vector_files[shard].append(vectors)
+    
+    def _read_vectors(self, refs: List[Tuple[Optional[bytes], Optional[int], Optional[int]]]) -> np.ndarray:
+        """Load vectors from (embedding blob, vector shard, vector offset) references"""
+        vectors = np.empty((len(refs), self.vector_dim), dtype=np.float32)
+        by_shard: Dict[int, List[int]] = {}
+        for position, (blob, shard, offset) in enumerate(refs):
+            if offset is None:
+                # Row written before the matrix files existed
+                vectors[position] = np.frombuffer(blob, dtype=np.float32)
+            else:
+                by_shard.setdefault(shard, []).append(position)
+        
+        for shard, positions in by_shard.items():
+            offsets = np.array([refs[position][2] for position in positions], dtype=np.int64)
+            vectors[positions] = self.vector_files[shard].read(offsets)
+        return vectors
+    
+    def _training_sample(self, limit: int = 10000) -> np.ndarray:
+        """Up to `limit` stored vectors, taken evenly from the matrix files"""
+        per_file = max(1, limit // len(self.vector_files))
+        parts = [np.array(vector_file.view()[:per_file]) for vector_file in self.vector_files]
+        return np.vstack(parts) if parts else np.empty((0, self.vector_dim), dtype=np.float32)
+    
+    def _sync_vector_files(self):
+        for vector_file in self.vector_files:
+            vector_file.flush()
+    
+    def _recover_lost_vectors(self):
+        """
+        Re-encode rows whose vectors lay in an unsynced tail of a matrix file
+        that a crash lost, so new appends never reuse offsets rows still point to.
+        """
+        for shard, vector_file in enumerate(self.vector_files):
+            rows = self.db.query(
+                "SELECT id, message FROM messages WHERE vector_shard = ? AND vector_offset >= ? ORDER BY id",
+                (shard, len(vector_file))
+            )
+            if not rows:
+                continue
+            logger.warning(
+                f"{len(rows)} rows point past the end of {vector_file.path} (lost in a crash?), re-encoding them"
+            )
+            first = vector_file.append(self._encode_batch([row[1] for row in rows]))
+            vector_file.flush()
+            self.db.executemany(
+                "UPDATE messages SET vector_offset = ? WHERE id = ?",
+                [(first + i, row[0]) for i, row in enumerate(rows)]
+            )
+            self.db.flush()
+    
+    def _migrate_blob_embeddings(self, batch_size: int = 10000):
+        """Move legacy per-row embedding BLOBs into the matrix files"""
+        migrated = 0
+        while True:
+            rows = self.db.query(
+                "SELECT id, username, embedding FROM messages "
+                "WHERE vector_offset IS NULL AND embedding IS NOT NULL ORDER BY id LIMIT ?",
+                (batch_size,)
+            )
+            if not rows:
+                break
+            
+            updates = []
+            for username, user_rows in groupby(rows, key=lambda row: row[1]):
+                user_rows = list(user_rows)
+                vectors = np.frombuffer(b"".join(row[2] for row in user_rows), dtype=np.float32)
+                shard, first = self._store_vectors(username, vectors.reshape(len(user_rows), self.vector_dim))
+                updates.extend((shard, first + i, row[0]) for i, row in enumerate(user_rows))
+            
+            # The UPDATE drops the only other copy of these vectors, whatever the durability
+            self._sync_vector_files()
+            self.db.executemany(
+                "UPDATE messages SET embedding = NULL, vector_shard = ?, vector_offset = ? WHERE id = ?",
+                updates
+            )
+            self.db.flush()
+            migrated += len(rows)
+        
+        if migrated:
+            logger.info(f"Migrated {migrated} embedding BLOBs into {self.vector_dir}")
     
-    def _load_existing_users(self):
-        """Load existing users from the database"""
-        conn = sqlite3.connect(self.db_path)
+    def _load_shared_vectors(
+        self,
+        after_id: int = 0,
+        shard_high_water: Optional[List[int]] = None,
+        user_high_water: Optional[Dict[str, int]] = None,
+        chunk_size: int = 65536,
+    ):
+        """
+        Bulk-load stored embeddings newer than `after_id` into the shared index.
+        Snapshot files restored with a later high-water mark of their own skip
+        the rows they already hold.
+        """
+        shard_high_water = shard_high_water or [after_id] * self.vector_index.num_shards
+        user_high_water = user_high_water or {}
+        conn = self.db.open_reader()
         cursor = conn.cursor()
+        shards: Dict[str, int] = {}
+        loaded = 0
+        
+        # Stream id/offset columns only; vectors come straight from the memory-mapped files
+        cursor.execute(
+            "SELECT id, username, vector_shard, vector_offset FROM messages "
+            "WHERE id > ? AND vector_offset IS NOT NULL AND compacted_into IS NULL ORDER BY id",
+            (after_id,)
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            loaded += len(rows)
+            self._last_indexed_id = max(self._last_indexed_id, rows[-1][0])
+            
+            # Users promoted to their own index (restored from a snapshot) are added one by one
+            promoted = [
+                row for row in rows
+                if self.vector_index.is_approximate(row[1]) and row[0] > user_high_water.get(row[1], after_id)
+            ]
+            if promoted:
+                for username, user_rows in groupby(sorted(promoted, key=lambda row: row[1]), key=lambda row: row[1]):
+                    user_rows = list(user_rows)
+                    vectors = self._read_vectors([(None, row[2], row[3]) for row in user_rows])
+                    self.vector_index.add(username, np.array([row[0] for row in user_rows], dtype=np.int64), vectors)
+            rows = [row for row in rows if not self.vector_index.is_approximate(row[1])]
+            
+            # Skip rows the restored shard snapshot already holds
+            rows = [
+                row for row in rows
+                if row[0] > shard_high_water[shards.setdefault(row[1], self.vector_index.shard_of(row[1]))]
+            ]
+            if not rows:
+                continue
+            
+            ids = np.array([row[0] for row in rows], dtype=np.int64)
+            index_shards = np.array([shards[row[1]] for row in rows], dtype=np.int64)
+            vector_shards = np.array([row[2] for row in rows], dtype=np.int64)
+            offsets = np.array([row[3] for row in rows], dtype=np.int64)
+            
+            # One FAISS call per (index shard, matrix file) pair in the chunk
+            for index_shard in np.unique(index_shards):
+                for vector_shard in np.unique(vector_shards[index_shards == index_shard]):
+                    mask = (index_shards == index_shard) & (vector_shards == vector_shard)
+                    vectors = self.vector_files[vector_shard].read(offsets[mask])
+                    self.vector_index.add_to_shard(int(index_shard), ids[mask], vectors)
+        
+        conn.close()
+        logger.info(
+            f"Loaded {loaded} embeddings newer than snapshot id {after_id}; "
+            f"{self.vector_index.ntotal()} in the shared index"
+        )
+    
+    def _indexed_row_count(self, last_id: int, username: Optional[str] = None) -> int:
+        """Number of embeddings with id <= last_id that were indexed as of last_id (optionally for one user)"""
+        sql = (
+            "SELECT COUNT(*) FROM messages WHERE id <= ? AND (embedding IS NOT NULL OR vector_offset IS NOT NULL) "
+            "AND (compacted_into IS NULL OR compacted_into > ?)"
+        )
+        params: List = [last_id, last_id]
+        if username is not None:
+            sql += " AND username = ?"
+            params.append(username)
+        return self.db.query(sql, params)[0][0]
+    
+    def _snapshot_meta(self) -> Dict:
+        # An untrained sq8 index stores fp16, so its snapshots are never reused once trained
+        return {"vector_dim": self.vector_dim, "codec": self.vector_index.storage_codec}
+    
+    def _restore_shared_snapshot(self) -> Tuple[int, Optional[List[int]], Optional[Dict[str, int]]]:
+        """
+        Load the latest shared-index snapshot.
+        Returns the last message id covered by every file in it, plus each
+        shard's and promoted user's own high-water mark for replaying newer rows.
+        """
+        latest = self.snapshots.latest_generation()
+        if latest is None:
+            return 0, None, None
+        directory, manifest = latest
+        
+        last_id = manifest["last_id"]
+        if (
+            manifest.get("meta") != self._snapshot_meta()
+            or manifest.get("num_shards") != self.vector_index.num_shards
+        ):
+            logger.info("Ignoring snapshot built with a different index configuration")
+            return 0, None, None
+        
+        # Files are serialized one at a time, each up to its own high-water mark
+        metas = manifest.get("files", {})
+        shard_files = [f"shard_{shard}.faiss" for shard in range(self.vector_index.num_shards)]
+        promoted_files = manifest.get("promoted", {})
+        shard_high_water = [metas.get(filename, {}).get("last_id", last_id) for filename in shard_files]
+        user_high_water = {
+            username: metas.get(filename, {}).get("last_id", last_id) for username, filename in promoted_files.items()
+        }
+        
+        try:
+            shards = [read_index_file(os.path.join(directory, filename))[0] for filename in shard_files]
+            promoted = {}
+            for username, filename in promoted_files.items():
+                index, meta = read_index_file(os.path.join(directory, filename))
+                promoted[username] = (index, metas.get(filename, meta).get("report", {}))
+        except Exception as e:
+            logger.error(f"Error loading snapshot {directory}: {str(e)}")
+            return 0, None, None
+        
+        # Rows written by another process below a high-water mark would be missing
+        shard_counts, user_counts = self._snapshot_row_counts(last_id, shard_high_water, user_high_water)
+        if [index.ntotal for index in shards] != shard_counts or any(
+            index.ntotal != user_counts[username] for username, (index, _) in promoted.items()
+        ):
+            logger.warning(f"Snapshot {directory} does not match the database, rebuilding from rows")
+            return 0, None, None
+        
+        for shard, index in enumerate(shards):
+            self.vector_index.restore_shard(shard, index)
+            self._generation_files[shard_files[shard]] = (
+                self.vector_index.shard_version(shard), dict(metas.get(shard_files[shard], {}), shard=shard)
+            )
+        for username, (index, report) in promoted.items():
+            self.vector_index.restore_approximate(username, index)
+            self.promotion_reports[username] = report
+            self._generation_files[promoted_files[username]] = (
+                self.vector_index.approximate_version(username),
+                dict(metas.get(promoted_files[username], {}), username=username, report=report),
+            )
+        self._generation_path = directory
+        self._last_indexed_id = last_id
+        self._drop_archived_vectors(after_id=last_id)
+        
+        logger.info(f"Restored {self.vector_index.ntotal()} embeddings from snapshot {directory}")
+        return last_id, shard_high_water, user_high_water
+    
+    def _snapshot_row_counts(
+        self, last_id: int, shard_high_water: List[int], user_high_water: Dict[str, int]
+    ) -> Tuple[List[int], Dict[str, int]]:
+        """
+        Embeddings each snapshot file should hold: its users' rows as indexed at
+        the file's own high-water mark (every mark is at least `last_id`).
+        """
+        shard_counts = [0] * self.vector_index.num_shards
+        user_counts = dict.fromkeys(user_high_water, 0)
+        
+        def destination(username: str):
+            if username in user_counts:
+                return user_counts, username, user_high_water[username]
+            shard = self.vector_index.shard_of(username)
+            return shard_counts, shard, shard_high_water[shard]
+        
+        has_vector = "(embedding IS NOT NULL OR vector_offset IS NOT NULL)"
+        for username, count in self.db.query(
+            f"SELECT username, COUNT(*) FROM messages WHERE id <= ? AND {has_vector} "
+            "AND (compacted_into IS NULL OR compacted_into > ?) GROUP BY username",
+            (last_id, last_id)
+        ):
+            counts, key, _ = destination(username)
+            counts[key] += count
+        
+        # Adjust for rows added or compacted between `last_id` and each file's mark
+        top = max([last_id, *shard_high_water, *user_high_water.values()])
+        if top > last_id:
+            for username, message_id, compacted_into in self.db.query(
+                f"SELECT username, id, compacted_into FROM messages WHERE {has_vector} "
+                "AND ((id > ? AND id <= ?) OR (compacted_into > ? AND compacted_into <= ?))",
+                (last_id, top, last_id, top)
+            ):
+                counts, key, high_water = destination(username)
+                indexed_then = message_id <= last_id and (compacted_into is None or compacted_into > last_id)
+                indexed_at_mark = message_id <= high_water and (compacted_into is None or compacted_into > high_water)
+                counts[key] += int(indexed_at_mark) - int(indexed_then)
+        return shard_counts, user_counts
+    
+    def _restore_user_snapshot(self, username: str) -> bool:
+        """Load a per-user approximate index snapshot and replay newer rows"""
+        path = self.snapshots.user_path(_user_key(username))
+        if not os.path.exists(path):
+            return False
+        try:
+            index, meta = read_index_file(path)
+        except Exception as e:
+            logger.error(f"Error loading snapshot for {username}: {str(e)}")
+            return False
         
-        # Get all users
-        cursor.execute("SELECT username FROM users")
-        users = cursor.fetchall()
+        last_id = meta.get("last_id", 0)
+        if (
+            meta.get("username") != username
+            or meta.get("meta") != self._snapshot_meta()
+            or self._indexed_row_count(last_id, username) != index.ntotal
+        ):
+            return False
+        # History compacted since the snapshot would leave archived vectors behind
+        if self.db.query(
+            "SELECT 1 FROM messages WHERE username = ? AND compacted_into > ? LIMIT 1", (username, last_id)
+        ):
+            return False
         
-        for (username,) in users:
-            # Initialize index for this user
-            self.user_indices[username] = faiss.IndexFlatL2(self.vector_dim)
-            self.user_messages[username] = []
+        newer_ids, newer_vectors = self._user_vectors(username, after_id=last_id)
+        if len(newer_ids):
+            index.add_with_ids(newer_vectors, newer_ids)
+        self.vector_index.restore_approximate(username, index)
+        self.promotion_reports[username] = meta.get("report", {})
+        self._user_snapshot_ids[username] = last_id
+        return True
+    
+    def write_snapshots(self):
+        """
+        Snapshot the FAISS indices that are expensive to rebuild.
+        Shared mode writes every shard and promoted user as one generation;
+        per-user mode writes each resident approximate index that has changed.
+        Each index is serialized under the lock on its own and written to disk
+        outside it before the next one, so the lock is never held across all of them.
+        """
+        try:
+            if self.vector_index.shared:
+                self._write_shared_snapshot()
+            else:
+                self._write_user_snapshots()
+        except Exception as e:
+            logger.error(f"Error writing FAISS snapshots: {str(e)}")
+    
+    def _snapshot_versions(self) -> Dict[str, int]:
+        """Current index version for every file of a shared generation"""
+        with self._lock:
+            versions = {
+                f"shard_{shard}.faiss": self.vector_index.shard_version(shard)
+                for shard in range(self.vector_index.num_shards)
+            }
+            for username in self.vector_index.approximate_indexes():
+                versions[f"user_{_user_key(username)}.faiss"] = self.vector_index.approximate_version(username)
+        return versions
+    
+    def _write_shared_snapshot(self):
+        previous = {filename: version for filename, (version, _) in self._generation_files.items()}
+        versions = self._snapshot_versions()
+        if versions == previous or (not previous and not any(versions.values())):
+            return
+        
+        written: Dict[str, Tuple[int, Dict]] = {}
+        linked: Set[str] = set()
+        manifest = {
+            "meta": self._snapshot_meta(),
+            "num_shards": self.vector_index.num_shards,
+            "promoted": {},
+        }
+        
+        def serialize(filename: str, version: int, index, meta: Dict):
+            """(data, meta) for one file, None data if the previous generation's copy is current"""
+            # Unchanged since the last generation, so its contents are also current as of now.
+            # Runs under the directory lock, so a generation still present here cannot be
+            # pruned by another worker before it is linked from
+            meta = dict(meta, last_id=self._last_indexed_id)
+            reusable = previous.get(filename) == version and os.path.exists(
+                os.path.join(self._generation_path, filename)
+            )
+            data = None if reusable else serialize_index(index)
+            if reusable:
+                linked.add(filename)
+            written[filename] = (version, meta)
+            return data, meta
+        
+        def files():
+            for shard in range(self.vector_index.num_shards):
+                filename = f"shard_{shard}.faiss"
+                with self._lock:
+                    index = self.vector_index.shard_indexes()[shard]
+                    data, meta = serialize(filename, self.vector_index.shard_version(shard), index, {"shard": shard})
+                yield filename, data, meta
+                del data
+            with self._lock:
+                usernames = list(self.vector_index.approximate_indexes())
+            for username in usernames:
+                filename = f"user_{_user_key(username)}.faiss"
+                with self._lock:
+                    index = self.vector_index.approximate_indexes().get(username)
+                    if index is None:
+                        continue
+                    data, meta = serialize(
+                        filename,
+                        self.vector_index.approximate_version(username),
+                        index,
+                        {"username": username, "report": self.promotion_reports.get(username, {})},
+                    )
+                manifest["promoted"][username] = filename
+                yield filename, data, meta
+                del data
+        
+        last_id = self._last_indexed_id
+        path = self.snapshots.write_generation(last_id, files(), manifest, previous=self._generation_path)
+        if path is None:
+            return
+        self._generation_path = path
+        self._generation_files = written
+        logger.info(
+            f"Wrote shared index snapshot up to message id {last_id} "
+            f"({len(written) - len(linked)} files serialized, {len(linked)} unchanged)"
+        )
+    
+    def _write_user_snapshots(self):
+        with self._lock:
+            usernames = list(self.vector_index.approximate_indexes())
+        for username in usernames:
+            with self._lock:
+                index = self.vector_index.approximate_indexes().get(username)
+                messages = self.user_messages.get(username)
+                if index is None or not messages:
+                    continue
+                last_id = int(messages.ids[-1])
+                if self._user_snapshot_ids.get(username) == last_id:
+                    continue
+                meta = {
+                    "username": username,
+                    "last_id": last_id,
+                    "meta": self._snapshot_meta(),
+                    "report": self.promotion_reports.get(username, {}),
+                }
+                data = serialize_index(index)
             
-            # Load messages for this user
-            cursor.execute(
-                "SELECT message, is_user, embedding, timestamp FROM messages WHERE username = ? ORDER BY timestamp",
-                (username,)
+            write_index_file(self.snapshots.user_path(_user_key(username)), data, meta)
+            del data
+            self._user_snapshot_ids[username] = last_id
+            logger.info(f"Wrote index snapshot for {username} up to message id {last_id}")
+    
+    def _snapshot_loop(self, interval_seconds: float):
+        while not self._snapshot_stop.wait(interval_seconds):
+            try:
+                self._maintenance_executor.submit(self.write_snapshots)
+            except RuntimeError:
+                # Executor already shut down
+                break
+    
+    def _hydrate(self, username: str) -> bool:
+        """Make a user resident in memory, loading them from the database if needed"""
+        self.last_activity = time.monotonic()
+        if username in self.user_messages:
+            self.user_messages.move_to_end(username)
+            return True
+        
+        known = bool(self.db.query("SELECT 1 FROM users WHERE username = ?", (username,)))
+        rows = self.db.query(
+            "SELECT id, message, is_user, timestamp, token_count, is_summary, duplicate_of, "
+            "embedding, vector_shard, vector_offset "
+            "FROM messages WHERE username = ? AND compacted_into IS NULL ORDER BY id",
+            (username,)
+        )
+        
+        if not known and not rows:
+            return False
+        
+        messages = MessageTable(capacity=max(len(rows), 16))
+        missing_counts = []
+        for message_id, message, is_user, timestamp, token_count, is_summary, duplicate_of, *_ in rows:
+            if token_count is None:
+                token_count = count_tokens(message)
+                missing_counts.append((token_count, message_id))
+            messages.append(
+                message_id,
+                message,
+                bool(is_user),
+                _parse_db_timestamp(timestamp),
+                token_count,
+                is_summary=bool(is_summary),
+                is_duplicate=duplicate_of is not None,
+            )
+        
+        # Backfill token counts for rows stored before they were tracked
+        if missing_counts:
+            self.db.executemany("UPDATE messages SET token_count = ? WHERE id = ?", missing_counts)
+        
+        # Shared shards already hold every vector, per-user indices are rebuilt here
+        if not self.vector_index.shared and not self._restore_user_snapshot(username):
+            self.vector_index.ensure_user(username)
+            # Duplicate references have no vector of their own
+            indexed = [row for row in rows if row[6] is None]
+            if indexed:
+                ids = np.array([row[0] for row in indexed], dtype=np.int64)
+                vectors = self._read_vectors([row[7:] for row in indexed])
+                self.vector_index.add(username, ids, vectors)
+        
+        self.user_messages[username] = messages
+        self._resident_messages += len(messages)
+        self.context_buffers[username] = self._new_context_buffer(messages)
+        self._evict()
+        self._maybe_promote(username)
+        
+        logger.info(f"Loaded {len(messages)} messages for user: {username}")
+        return True
+    
+    def _new_context_buffer(self, messages: MessageTable) -> ContextBuffer:
+        """Context buffer seeded with a user's latest turns and rolling summary"""
+        buffer = ContextBuffer(self.context_buffer_size)
+        turns = np.flatnonzero(~messages.is_summary)
+        buffer.extend(messages[i] for i in turns[-self.context_buffer_size:])
+        summaries = np.flatnonzero(messages.is_summary)
+        if len(summaries):
+            summary = messages[summaries[-1]]
+            buffer.set_summary(summary["message"], summary["tokens"])
+        return buffer
+    
+    def _evict(self):
+        """Evict least recently used users until the residency budget is met"""
+        def over_budget() -> bool:
+            if self.max_resident_users is not None and len(self.user_messages) > self.max_resident_users:
+                return True
+            if self.max_resident_messages is not None and self._resident_messages > self.max_resident_messages:
+                return True
+            return False
+        
+        # The most recently used user always stays resident
+        while len(self.user_messages) > 1 and over_budget():
+            username, messages = self.user_messages.popitem(last=False)
+            self._resident_messages -= len(messages)
+            self.context_buffers.pop(username, None)
+            self.vector_index.drop_user(username)
+            logger.info(f"Evicted user from memory: {username}")
+    
+    def _maybe_promote(self, username: str):
+        """Schedule a background switch to an approximate index for heavy users"""
+        if (
+            self.approx_index_threshold is not None
+            and len(self.user_messages.get(username, ())) >= self.approx_index_threshold
+            and not self.vector_index.is_approximate(username)
+            and username not in self._promoting
+        ):
+            self._promoting.add(username)
+            self._maintenance_executor.submit(self._promote_user, username)
+    
+    def _user_vectors(self, username: str, after_id: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Stored (ids, vectors) for a user's messages newer than `after_id`"""
+        rows = self.db.query(
+            "SELECT id, embedding, vector_shard, vector_offset FROM messages "
+            "WHERE username = ? AND id > ? AND (embedding IS NOT NULL OR vector_offset IS NOT NULL) "
+            "AND compacted_into IS NULL ORDER BY id",
+            (username, after_id)
+        )
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        return ids, self._read_vectors([row[1:] for row in rows])
+    
+    def _promote_user(self, username: str):
+        """Build an approximate index for a user off the request path and swap it in"""
+        try:
+            ids, vectors = self._user_vectors(username)
+            if len(ids) == 0:
+                return
+            index, report = build_approximate_index(
+                self.vector_dim,
+                ids,
+                vectors,
+                kind=self.approx_index_kind,
+                codec=self.vector_index.codec,
+                recall_target=self.approx_recall_target,
             )
             
-            for message, is_user, embedding_blob, timestamp in cursor.fetchall():
-                # Convert blob to numpy array
-                embedding = np.frombuffer(embedding_blob, dtype=np.float32)
+            with self._lock:
+                # A per-user index may have been evicted while we were building
+                if not self.vector_index.has_user(username):
+                    return
                 
-                # Add to in-memory storage
-                self.user_messages[username].append({
-                    "message": message,
-                    "is_user": bool(is_user),
-                    "timestamp": timestamp
-                })
+                # Replay messages added while the index was being built
+                newer_ids, newer_vectors = self._user_vectors(username, after_id=int(ids[-1]))
+                if len(newer_ids):
+                    index.add_with_ids(newer_vectors, newer_ids)
                 
-                # Add to FAISS index
-                self.user_indices[username].add(np.array([embedding]))
+                self.vector_index.install_approximate(username, index, np.concatenate([ids, newer_ids]))
+                self.promotion_reports[username] = report
+            
+            logger.info(
+                f"Promoted {username} to {report['kind']} index: {report['search_knob']}={report['search_value']}, "
+                f"recall@{report['k']}={report['recall_at_k']:.3f}, {report['latency_ms_per_query']:.2f} ms/query"
+            )
+            
+            # Persist the new index right away, it is the expensive part to rebuild
+            self.write_snapshots()
+        except Exception as e:
+            logger.error(f"Error promoting {username} to an approximate index: {str(e)}")
+        finally:
+            with self._lock:
+                self._promoting.discard(username)
+    
+    def _maybe_train_codec(self):
+        """Schedule deferred codec training once enough vectors are stored"""
+        if (
+            self.vector_index.needs_training()
+            and not self._codec_training
+            and sum(len(vector_file) for vector_file in self.vector_files) >= self.vector_index.min_training_vectors
+        ):
+            self._codec_training = True
+            self._maintenance_executor.submit(self._train_codec)
+    
+    def _train_codec(self):
+        """Train the codec on stored vectors, re-encode the indices and measure the recall it costs"""
+        try:
+            sample = self._training_sample()
+            with self._lock:
+                if not self.vector_index.retrain(sample):
+                    return
+            self.codec_recall = self.vector_index.measure_recall(sample)
+            logger.info(
+                f"Trained {self.vector_index.codec} codec on {len(sample)} vectors: "
+                f"recall@10 vs float32 = {self.codec_recall:.3f}"
+            )
+        except Exception as e:
+            logger.error(f"Error training the {self.vector_index.codec} codec: {str(e)}")
+        finally:
+            with self._lock:
+                self._codec_training = False
+    
+    def _schedule_rebuild(self, username: str):
+        """Rebuild a user's approximate index from their live vectors in the background"""
+        if username not in self._promoting:
+            self._promoting.add(username)
+            self._maintenance_executor.submit(self._promote_user, username)
+    
+    def _remove_vectors(self, username: str, ids: np.ndarray):
+        """Drop vectors from the hot index, rebuilding indices that cannot delete"""
+        if not self.vector_index.remove(username, ids):
+            self._schedule_rebuild(username)
+    
+    def _drop_archived_vectors(self, after_id: int):
+        """Remove vectors compacted after `after_id` from a restored snapshot"""
+        rows = self.db.query(
+            "SELECT username, id FROM messages WHERE compacted_into > ? ORDER BY username", (after_id,)
+        )
+        for username, user_rows in groupby(rows, key=lambda row: row[0]):
+            self._remove_vectors(username, np.array([row[1] for row in user_rows], dtype=np.int64))
+    
+    def compaction_candidates(self, min_turns: int) -> List[str]:
+        """Users with more than `min_turns` live (uncompacted) messages"""
+        rows = self.db.query(
+            "SELECT username FROM messages WHERE compacted_into IS NULL AND is_summary = 0 "
+            "GROUP BY username HAVING COUNT(*) > ?",
+            (min_turns,)
+        )
+        return [row[0] for row in rows]
+    
+    def compaction_batch(
+        self, username: str, keep_recent: int, batch_size: int
+    ) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        The user's current rolling summary (or None) and up to `batch_size` of
+        their oldest live turns, never touching the newest `keep_recent`.
+        """
+        summary_rows = self.db.query(
+            "SELECT id, message FROM messages WHERE username = ? AND is_summary = 1 AND compacted_into IS NULL "
+            "ORDER BY id DESC LIMIT 1",
+            (username,)
+        )
+        live = self.db.query(
+            "SELECT COUNT(*) FROM messages WHERE username = ? AND is_summary = 0 AND compacted_into IS NULL",
+            (username,)
+        )[0][0]
+        rows = self.db.query(
+            "SELECT id, message, is_user, timestamp FROM messages "
+            "WHERE username = ? AND is_summary = 0 AND compacted_into IS NULL ORDER BY id LIMIT ?",
+            (username, max(min(batch_size, live - keep_recent), 0))
+        )
+        summary = {"id": summary_rows[0][0], "message": summary_rows[0][1]} if summary_rows else None
+        turns = [
+            {"id": message_id, "message": message, "is_user": bool(is_user), "timestamp": timestamp}
+            for message_id, message, is_user, timestamp in rows
+        ]
+        return summary, turns
+    
+    def apply_compaction(self, username: str, summary: str, folded_ids: List[int], timestamp: str) -> int:
+        """
+        Store a new rolling summary and archive the rows it replaces.
+        Archived rows stay in SQLite (pointing at the summary) but leave the
+        resident history and the FAISS index. Returns the summary's id.
+        """
+        embedding = self.embed(summary).result()
+        folded = np.array(sorted(folded_ids), dtype=np.int64)
         
-        conn.close()
-        logger.info(f"Loaded {len(users)} existing users from database")
+        with self._lock:
+            vector_shard, vector_offset = self._store_vectors(username, embedding)
+            token_count = count_tokens(summary)
+            cursor = self.db.execute(
+                "INSERT INTO messages (username, message, is_user, timestamp, content_hash, vector_shard, "
+                "vector_offset, token_count, is_summary) VALUES (?, ?, 0, ?, ?, ?, ?, ?, 1)",
+                (username, summary, timestamp, self._content_hash(summary), vector_shard, vector_offset, token_count)
+            )
+            summary_id = cursor.lastrowid
+            self.db.executemany(
+                "UPDATE messages SET compacted_into = ? WHERE id = ?",
+                [(summary_id, int(message_id)) for message_id in folded]
+            )
+            
+            # Resident history keeps id order: surviving rows, then the summary
+            messages = self.user_messages.get(username)
+            if messages is not None:
+                compacted = MessageTable(capacity=max(len(messages), 16))
+                compacted.extend_from(messages, np.flatnonzero(~np.isin(messages.ids, folded)))
+                compacted.append(
+                    summary_id, summary, False, _parse_db_timestamp(timestamp), token_count, is_summary=True
+                )
+                self.user_messages[username] = compacted
+                self._resident_messages += len(compacted) - len(messages)
+                # Rebuilt rather than given the summary, so folded turns leave the recent lines too
+                self.context_buffers[username] = self._new_context_buffer(compacted)
+            
+            if self.vector_index.has_user(username):
+                self.vector_index.add(username, np.array([summary_id]), np.array([embedding]))
+                self._remove_vectors(username, folded)
+            self._last_indexed_id = max(self._last_indexed_id, summary_id)
+        
+        logger.info(f"Compacted {len(folded)} messages for user {username} into summary {summary_id}")
+        return summary_id
+    
+    def index_stats(self) -> Dict:
+        """Vector index sizes and approximate-index promotions"""
+        with self._lock:
+            return {
+                "vectors": self.vector_index.ntotal(),
+                "codec": self.vector_index.codec,
+                "storage_codec": self.vector_index.storage_codec,
+                "bytes_per_vector": bytes_per_vector(self.vector_dim, self.vector_index.storage_codec),
+                "codec_recall_at_10": self.codec_recall,
+                "rerank": self.rerank,
+                "duplicates_suppressed": self._duplicates_suppressed,
+                "retrieval_fallbacks": self._retrieval_fallbacks,
+                "approximate_indexes": self.vector_index.approximate_count(),
+                "promotions_in_progress": len(self._promoting),
+                "promotions": dict(self.promotion_reports),
+            }
+    
+    def _vectors_for_ids(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Full-precision (ids, vectors) for stored message ids, in ascending id order"""
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.vector_dim), dtype=np.float32)
+        placeholders = ",".join("?" * len(ids))
+        rows = self.db.query(
+            f"SELECT id, embedding, vector_shard, vector_offset FROM messages WHERE id IN ({placeholders}) "
+            "AND (embedding IS NOT NULL OR vector_offset IS NOT NULL) ORDER BY id",
+            [int(message_id) for message_id in ids]
+        )
+        return np.array([row[0] for row in rows], dtype=np.int64), self._read_vectors([row[1:] for row in rows])
+    
+    def _search(
+        self, username: str, query_embedding: np.ndarray, k: int, message_ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search a user's vectors, optionally re-ranking compressed results at full precision"""
+        fetch = k * self.rerank_factor if self.rerank else k
+        distances, ids = self.vector_index.search(
+            username, np.array([query_embedding]), fetch, user_ids=message_ids
+        )
+        distances, ids = distances[0], ids[0]
+        if not self.rerank or len(ids) == 0:
+            return distances, ids
+        
+        ids, vectors = self._vectors_for_ids(ids[ids >= 0])
+        exact = ((vectors - query_embedding) ** 2).sum(axis=1)
+        order = np.argsort(exact)[:k]
+        return exact[order], ids[order]
+    
+    def _semantic_positions(
+        self, username: str, query_embedding: np.ndarray, k: int, message_ids: np.ndarray
+    ) -> np.ndarray:
+        """Positions of the user's k nearest messages, best first"""
+        # Missing (-1) or stale ids shrink a result, so widen the search until k are found
+        fetch = k
+        while True:
+            _, ids = self._search(username, query_embedding, fetch, message_ids)
+            ids = ids[ids >= 0]
+            positions = np.searchsorted(message_ids, ids)
+            positions = np.minimum(positions, len(message_ids) - 1)
+            positions = positions[message_ids[positions] == ids]
+            if len(positions) >= k or fetch >= len(message_ids):
+                return positions[:k]
+            fetch = min(fetch * 2, len(message_ids))
+    
+    def _hybrid_positions(
+        self, username: str, messages: MessageTable, query_embedding: np.ndarray, k: int, message_ids: np.ndarray
+    ) -> np.ndarray:
+        """Positions of the top-k messages by weighted similarity and recency, best first"""
+        pool = min(len(messages), max(k * 4, self.hybrid_candidates))
+        candidates = np.union1d(
+            self._semantic_positions(username, query_embedding, pool, message_ids),
+            np.arange(len(messages) - pool, len(messages)),
+        )
+        
+        ids, vectors = self._vectors_for_ids(message_ids[candidates])
+        candidates = candidates[np.isin(message_ids[candidates], ids)]
+        # Score every candidate in one pass: cosine similarity and exponential time decay
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_embedding)
+        similarity = vectors @ query_embedding / np.maximum(norms, 1e-12)
+        created_at = messages.created_at[candidates]
+        age = np.maximum(time.time() - created_at, 0.0)
+        recency = np.exp(-np.log(2.0) * age / self.recency_half_life_seconds)
+        score = self.hybrid_semantic_weight * similarity + (1.0 - self.hybrid_semantic_weight) * recency
+        
+        if len(candidates) <= k:
+            return candidates[np.argsort(-score)]
+        top = np.argpartition(-score, k - 1)[:k]
+        return candidates[top[np.argsort(-score[top])]]
     
     def user_exists(self, username: str) -> bool:
         """Check if a user exists in the memory store"""
-        return username in self.user_indices
+        with self._lock:
+            return self._hydrate(username)
     
     def initialize_user(self, username: str):
         """Initialize memory for a new user"""
-        if username in self.user_indices:
-            return
-        
-        # Create FAISS index for this user
-        self.user_indices[username] = faiss.IndexFlatL2(self.vector_dim)
-        self.user_messages[username] = []
-        
-        # Add user to database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
-        conn.commit()
-        conn.close()
-        
+        with self._lock:
+            if self._hydrate(username):
+                return
+            
+            # Create FAISS index for this user
+            self.vector_index.ensure_user(username)
+            self.user_messages[username] = MessageTable()
+            self.context_buffers[username] = ContextBuffer(self.context_buffer_size)
+            
+            # Add user to database
+            self.db.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+            
+            self._evict()
         logger.info(f"Initialized memory for user: {username}")
     
-    def add_message(self, username: str, message: str, is_user: bool):
-        """Add a message to the user's memory"""
-        if username not in self.user_indices:
+    def add_message(self, username: str, message: str, is_user: bool, embedding: Optional[np.ndarray] = None):
+        """Add a message to the user's memory, reusing its embedding if already computed"""
+        # Generate embedding outside the lock so concurrent calls can share a batch
+        if embedding is None:
+            embedding = self.embed(message).result()
+        
+        with self._lock:
             self.initialize_user(username)
+            token_count = count_tokens(message)
+            
+            duplicate_of = self._find_recent_duplicate(username, embedding, is_user)
+            if duplicate_of is not None:
+                # Keep the turn in the timeline, but let it point at the original's vector
+                cursor = self.db.execute(
+                    "INSERT INTO messages (username, message, is_user, content_hash, token_count, duplicate_of) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (username, message, is_user, self._content_hash(message), token_count, duplicate_of)
+                )
+                self.user_messages[username].append(
+                    cursor.lastrowid, message, is_user, time.time(), token_count, is_duplicate=True
+                )
+                self._resident_messages += 1
+                self.context_buffers[username].append(message, is_user, token_count)
+                self._duplicates_suppressed += 1
+                self._evict()
+                logger.info(f"Stored near-duplicate of message {duplicate_of} for user: {username}")
+                return
+            
+            # Vector goes to the matrix file, SQLite keeps its offset
+            vector_shard, vector_offset = self._store_vectors(username, embedding)
+            
+            # Add to database first, the row id doubles as the FAISS id
+            cursor = self.db.execute(
+                "INSERT INTO messages (username, message, is_user, content_hash, vector_shard, vector_offset, token_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (username, message, is_user, self._content_hash(message), vector_shard, vector_offset, token_count)
+            )
+            message_id = cursor.lastrowid
+            
+            # Add to in-memory storage
+            self.user_messages[username].append(message_id, message, is_user, time.time(), token_count)
+            self._resident_messages += 1
+            self.context_buffers[username].append(message, is_user, token_count)
+            
+            # Add to FAISS index
+            self.vector_index.add(username, np.array([message_id]), np.array([embedding]))
+            self._last_indexed_id = max(self._last_indexed_id, message_id)
+            self._evict()
+            self._maybe_promote(username)
+            self._maybe_train_codec()
         
-        # Generate embedding
-        embedding = self.model.encode(message, convert_to_numpy=True).astype(np.float32)
+        logger.info(f"Added message to memory for user: {username}")
+    
+    def _find_recent_duplicate(self, username: str, embedding: np.ndarray, is_user: bool) -> Optional[int]:
+        """Id of a same-role message among the user's last `dedupe_window` with cosine >= `dedupe_threshold`"""
+        if self.dedupe_threshold is None:
+            return None
+        messages = self.user_messages[username]
+        start = max(len(messages) - self.dedupe_window, 0)
+        eligible = (
+            (messages.is_user[start:] == bool(is_user)) & ~messages.is_summary[start:] & ~messages.is_duplicate[start:]
+        )
+        ids, vectors = self._vectors_for_ids(messages.ids[start:][eligible])
+        if len(ids) == 0:
+            return None
         
-        # Add to in-memory storage
-        timestamp = datetime.now().isoformat()
-        self.user_messages[username].append({
-            "message": message,
-            "is_user": is_user,
-            "timestamp": timestamp
-        })
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(embedding)
+        similarity = vectors @ embedding / np.maximum(norms, 1e-12)
+        best = int(np.argmax(similarity))
+        return int(ids[best]) if similarity[best] >= self.dedupe_threshold else None
+    
+    def _ranked_messages(
+        self,
+        username: str,
+        query: str = None,
+        k: int = 5,
+        mode: Optional[str] = None,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> List[Dict]:
+        """Up to k of a user's messages, most valuable first"""
+        if _is_recency(query, mode):
+            query_embedding = None
+        elif query_embedding is None:
+            query_embedding = self.embed(query).result()
         
-        # Add to FAISS index
-        self.user_indices[username].add(np.array([embedding]))
+        with self._lock:
+            if not self._hydrate(username):
+                return []
+            
+            messages = self.user_messages[username]
+            if not messages or k <= 0:
+                return []
+            
+            if query_embedding is None:
+                # Get the most recent turns (summaries lead the context buffer instead)
+                return [messages[i] for i in np.flatnonzero(~messages.is_summary)[-k:][::-1]]
+            
+            message_ids = messages.ids
+            if mode == "semantic":
+                positions = self._semantic_positions(username, query_embedding, k, message_ids)
+            else:
+                positions = self._hybrid_positions(username, messages, query_embedding, k, message_ids)
+            return [messages[i] for i in positions]
+    
+    def get_relevant_messages(
+        self, username: str, query: str = None, k: int = 5, mode: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Select up to k of a user's messages.
+        mode is "recency" (latest k), "semantic" (nearest k to the query, best
+        first) or "hybrid" (top k by similarity and time decay, oldest first).
+        Defaults to "semantic" with a query and "recency" without one.
+        """
+        mode = mode or ("semantic" if query else "recency")
+        ranked = self._ranked_messages(username, query=query, k=k, mode=mode)
+        if mode == "semantic":
+            return ranked
+        # Chronological order for prompt assembly
+        return sorted(ranked, key=_chronological_key)
+    
+    def build_context(
+        self,
+        username: str,
+        token_budget: int,
+        query: str = None,
+        mode: Optional[str] = None,
+        max_candidates: int = 50,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> str:
+        """
+        Pack the most valuable messages into a "User: .../Assistant: ..." context
+        of at most `token_budget` tokens, in chronological order.
+        """
+        if _is_recency(query, mode) and max_candidates <= self.context_buffer_size:
+            with self._lock:
+                if not self._hydrate(username):
+                    return ""
+                return self.context_buffers[username].pack(token_budget)
         
-        # Add to database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO messages (username, message, is_user, embedding) VALUES (?, ?, ?, ?)",
-            (username, message, is_user, embedding.tobytes())
+        ranked = self._ranked_messages(
+            username, query=query, k=max_candidates, mode=mode, query_embedding=query_embedding
         )
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"Added message to memory for user: {username}")
+        packed = pack_by_budget(((msg, msg["tokens"]) for msg in ranked), token_budget)
+        return self._format_context(sorted(packed, key=_chronological_key))
+    
+    def _format_context(self, messages: List[Dict]) -> str:
+        return "".join(render_line(msg["message"], msg["is_user"], msg["is_summary"]) for msg in messages)
     
-    def get_context_for_user(self, username: str, query: str = None, k: int = 5) -> str:
+    def get_context_for_user(
+        self, username: str, query: str = None, k: int = 5, mode: Optional[str] = None
+    ) -> str:
         """Get relevant context for a user based on query or recent messages"""
-        if username not in self.user_indices:
-            return ""
+        if _is_recency(query, mode) and k <= self.context_buffer_size:
+            # Recent context comes straight from the pre-rendered ring buffer
+            with self._lock:
+                if not self._hydrate(username):
+                    return ""
+                return self.context_buffers[username].render(k)
+        
+        return self._format_context(self.get_relevant_messages(username, query=query, k=k, mode=mode))
+    
+    def get_all_messages_for_user(self, username: str) -> List[Dict]:
+        """Get all messages for a user"""
+        with self._lock:
+            if not self._hydrate(username):
+                return []
+            
+            return list(self.user_messages[username])
+    
+    def import_messages(
+        self,
+        records: Iterable[Dict],
+        chunk_size: int = 5000,
+        encode_batch_size: int = 256,
+        progress: Optional[Callable[[Dict], None]] = None,
+    ) -> Dict:
+        """
+        Bulk-load message records (username, message, is_user and optionally
+        timestamp, is_summary and a precomputed embedding) in chunks.
+        Each chunk is encoded in large batches, appended to the matrix files with
+        one write per file, inserted with one executemany and added to FAISS per
+        shard or user. `progress` receives running totals after every chunk.
+        """
+        started = time.perf_counter()
+        stats = {"messages": 0, "encoded": 0, "seconds": 0.0, "per_second": 0.0}
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            stats["encoded"] += self._import_chunk(chunk, encode_batch_size)
+            stats["messages"] += len(chunk)
+            stats["seconds"] = time.perf_counter() - started
+            stats["per_second"] = stats["messages"] / max(stats["seconds"], 1e-9)
+            if progress is not None:
+                progress(dict(stats))
+        
+        self.db.flush()
+        return stats
+    
+    def _import_chunk(self, chunk: List[Dict], encode_batch_size: int) -> int:
+        """Store and index one chunk of import records, returning how many were encoded"""
+        vectors = np.empty((len(chunk), self.vector_dim), dtype=np.float32)
+        hashes = [self._content_hash(record["message"]) for record in chunk]
+        token_counts = [count_tokens(record["message"]) for record in chunk]
         
-        if not self.user_messages[username]:
-            return ""
+        # Precomputed and cached vectors are reused, repeated texts are encoded once
+        pending: Dict[str, List[int]] = {}
+        for position, (record, key) in enumerate(zip(chunk, hashes)):
+            if record.get("embedding") is not None:
+                vectors[position] = np.asarray(record["embedding"], dtype=np.float32)
+                continue
+            cached = self.embedding_cache.get(key)
+            if cached is not None:
+                vectors[position] = cached
+            else:
+                pending.setdefault(key, []).append(position)
+        if pending:
+            groups = list(pending.values())
+            encoded = self.model.encode(
+                [chunk[group[0]]["message"] for group in groups], batch_size=encode_batch_size
+            )
+            for group, vector in zip(groups, encoded):
+                vectors[group] = vector
         
-        if query:
-            # Search for relevant messages using the query
-            query_embedding = self.model.encode(query, convert_to_numpy=True).astype(np.float32)
-            distances, indices = self.user_indices[username].search(
-                np.array([query_embedding]), k
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO users (username) VALUES (?)",
+                [(username,) for username in {record["username"] for record in chunk}]
             )
             
-            # Get the relevant messages
-            relevant_messages = [
-                self.user_messages[username][i] for i in indices[0] if i < len(self.user_messages[username])
-            ]
-        else:
-            # Get the most recent messages
-            relevant_messages = self.user_messages[username][-k:]
+            # One append per matrix file
+            vector_shards = np.array(
+                [shard_for(record["username"], len(self.vector_files)) for record in chunk], dtype=np.int64
+            )
+            offsets = np.empty(len(chunk), dtype=np.int64)
+            for vector_shard in np.unique(vector_shards):
+                mask = vector_shards == vector_shard
+                first = self.vector_files[vector_shard].append(vectors[mask])
+                offsets[mask] = first + np.arange(int(mask.sum()))
+            
+            ids = np.array(self.db.insert_many(
+                "INSERT INTO messages (username, message, is_user, timestamp, content_hash, vector_shard, "
+                "vector_offset, token_count, is_summary) VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?, ?)",
+                [
+                    (
+                        record["username"], record["message"], bool(record.get("is_user")), record.get("timestamp"),
+                        key, int(vector_shard), int(offset), tokens, bool(record.get("is_summary")),
+                    )
+                    for record, key, vector_shard, offset, tokens in zip(chunk, hashes, vector_shards, offsets, token_counts)
+                ]
+            ), dtype=np.int64)
+            
+            self._index_imported(chunk, ids, vectors, token_counts)
+            self._last_indexed_id = max(self._last_indexed_id, int(ids[-1]))
+        
+        return len(pending)
+    
+    def _index_imported(self, chunk: List[Dict], ids: np.ndarray, vectors: np.ndarray, token_counts: List[int]):
+        """Add imported rows to resident users and to FAISS, one call per shard or user"""
+        by_user: Dict[str, List[int]] = {}
+        for position, record in enumerate(chunk):
+            by_user.setdefault(record["username"], []).append(position)
+        
+        shard_positions: Dict[int, List[int]] = {}
+        for username, positions in by_user.items():
+            messages = self.user_messages.get(username)
+            if messages is not None:
+                for position in positions:
+                    record = chunk[position]
+                    timestamp = record.get("timestamp")
+                    created_at = _parse_db_timestamp(timestamp) if timestamp else time.time()
+                    is_summary = bool(record.get("is_summary"))
+                    messages.append(
+                        int(ids[position]), record["message"], bool(record.get("is_user")), created_at,
+                        token_counts[position], is_summary=is_summary
+                    )
+                    if is_summary:
+                        self.context_buffers[username].set_summary(record["message"], token_counts[position])
+                    else:
+                        self.context_buffers[username].append(
+                            record["message"], bool(record.get("is_user")), token_counts[position]
+                        )
+                self._resident_messages += len(positions)
+            
+            # Shared shards take every user's rows in one add; dedicated indices per user
+            if self.vector_index.shared and not self.vector_index.is_approximate(username):
+                shard_positions.setdefault(self.vector_index.shard_of(username), []).extend(positions)
+            elif self.vector_index.has_user(username):
+                self.vector_index.add(username, ids[positions], vectors[positions])
         
-        # Format the context
-        context = ""
-        for msg in relevant_messages:
-            speaker = "User" if msg["is_user"] else "Assistant"
-            context += f"{speaker}: {msg['message']}\n"
+        for shard, positions in shard_positions.items():
+            self.vector_index.add_to_shard(shard, ids[positions], vectors[positions])
         
-        return context
+        for username in by_user:
+            if username in self.user_messages:
+                self._maybe_promote(username)
+        self._maybe_train_codec()
+        self._evict()
     
-    def get_all_messages_for_user(self, username: str) -> List[Dict]:
-        """Get all messages for a user"""
-        if username not in self.user_messages:
-            return []
+    def export_messages(
+        self, usernames: Optional[List[str]] = None, include_embeddings: bool = False, chunk_size: int = 10000
+    ) -> Iterator[Dict]:
+        """
+        Stream live (not compacted) messages in id order as import_messages records.
+        Reads committed data on a separate connection, so writers are not blocked.
+        """
+        self.db.flush()
+        sql = (
+            "SELECT username, message, is_user, timestamp, is_summary, embedding, vector_shard, vector_offset "
+            "FROM messages WHERE compacted_into IS NULL"
+        )
+        params: List = []
+        if usernames:
+            sql += f" AND username IN ({','.join('?' * len(usernames))})"
+            params.extend(usernames)
+        sql += " ORDER BY id"
         
-        return self.user_messages[username]
+        conn = self.db.open_reader()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                vectors = None
+                if include_embeddings:
+                    # Near-duplicate references have no vector to export
+                    stored = [i for i, row in enumerate(rows) if row[5] is not None or row[7] is not None]
+                    vectors = dict(zip(stored, self._read_vectors([rows[i][5:] for i in stored])))
+                for position, (username, message, is_user, timestamp, is_summary, *_) in enumerate(rows):
+                    record = {
+                        "username": username,
+                        "message": message,
+                        "is_user": bool(is_user),
+                        "timestamp": timestamp,
+                        "is_summary": bool(is_summary),
+                    }
+                    if vectors is not None and position in vectors:
+                        record["embedding"] = vectors[position]
+                    yield record
+        finally:
+            conn.close()
+    
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    async def auser_exists(self, username: str) -> bool:
+        """Awaitable user_exists, run off the event loop"""
+        return await self._run_in_executor(self.user_exists, username)
+    
+    async def ainitialize_user(self, username: str):
+        """Awaitable initialize_user, run off the event loop"""
+        await self._run_in_executor(self.initialize_user, username)
+    
+    async def aadd_message(
+        self, username: str, message: str, is_user: bool, embedding: Optional[np.ndarray] = None
+    ):
+        """Awaitable add_message, run off the event loop"""
+        await self._run_in_executor(self.add_message, username, message, is_user, embedding=embedding)
+    
+    async def aget_context_for_user(
+        self, username: str, query: str = None, k: int = 5, mode: Optional[str] = None
+    ) -> str:
+        """Awaitable get_context_for_user, run off the event loop"""
+        return await self._run_in_executor(self.get_context_for_user, username, query=query, k=k, mode=mode)
+    
+    async def abuild_context(
+        self,
+        username: str,
+        token_budget: int,
+        query: str = None,
+        mode: Optional[str] = None,
+        max_candidates: int = 50,
+    ) -> str:
+        """Awaitable build_context, run off the event loop"""
+        return await self._run_in_executor(
+            self.build_context, username, token_budget, query=query, mode=mode, max_candidates=max_candidates
+        )
+    
+    async def aget_context_for_message(
+        self, username: str, message: str, token_budget: int, max_candidates: int = 50
+    ) -> Tuple[str, Optional[np.ndarray]]:
+        """
+        Context relevant to an incoming message (in `retrieval_mode`) and the
+        message's embedding, to pass on to add_message so it is encoded once.
+        If encoding plus retrieval overruns `retrieval_budget_ms` the latest
+        messages of a resident user are used instead (without waiting on the
+        store lock), with the embedding only if it is ready.
+        """
+        embedding_futures: List[asyncio.Future] = []
+        
+        async def retrieve() -> Tuple[str, np.ndarray]:
+            # A cache miss queries SQLite (behind the writer's lock), so even the lookup leaves the loop
+            embedding_future = asyncio.wrap_future(await self._run_in_executor(self.embed, message))
+            embedding_futures.append(embedding_future)
+            # Shielded: the batcher owns the future, a timeout must not cancel it
+            embedding = await asyncio.shield(embedding_future)
+            context = await self._run_in_executor(
+                self.build_context,
+                username,
+                token_budget,
+                query=message,
+                mode=self.retrieval_mode,
+                max_candidates=max_candidates,
+                query_embedding=embedding,
+            )
+            return context, embedding
+        
+        try:
+            return await asyncio.wait_for(retrieve(), self.retrieval_budget_seconds)
+        except asyncio.TimeoutError:
+            self._retrieval_fallbacks += 1
+            logger.warning(f"Context retrieval for {username} exceeded its budget, using recent messages")
+        
+        # The timed-out retrieval may still hold the store lock, so read the buffer directly
+        buffer = self.context_buffers.get(username)
+        context = buffer.pack(token_budget) if buffer is not None else ""
+        embedding = None
+        if embedding_futures and embedding_futures[0].done() and not embedding_futures[0].exception():
+            embedding = embedding_futures[0].result()
+        return context, embedding
+    
+    async def aget_all_messages_for_user(self, username: str) -> List[Dict]:
+        """Awaitable get_all_messages_for_user, run off the event loop"""
+        return await self._run_in_executor(self.get_all_messages_for_user, username)
+    
+    async def aimport_messages(self, records: List[Dict], chunk_size: int = 5000) -> Dict:
+        """Awaitable import_messages, run off the event loop"""
+        return await self._run_in_executor(self.import_messages, records, chunk_size=chunk_size)
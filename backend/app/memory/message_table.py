@@ -0,0 +1,142 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Union
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Bits of the per-row flags column
+IS_USER = 1
+IS_SUMMARY = 2
+IS_DUPLICATE = 4
+
+
+class MessageTable:
+    """
+    Append-only, array-backed message history for one user.
+    - Text lives in one UTF-8 arena, each row keeps an offset into it.
+    - Ids, int64 epoch milliseconds, token counts and role/summary flags are packed
+      numpy columns that grow geometrically, so search code reads them without
+      touching Python objects.
+    - Indexing returns a row dict built on demand; nothing per-row is kept alive.
+    """
+
+    def __init__(self, capacity: int = 16):
+        self._size = 0
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._created_ms = np.empty(capacity, dtype=np.int64)
+        self._tokens = np.empty(capacity, dtype=np.int32)
+        self._flags = np.empty(capacity, dtype=np.uint8)
+        self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._arena = bytearray()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(self._size):
+            yield self._row(i)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(key, slice):
+            return [self._row(i) for i in range(*key.indices(self._size))]
+        if key < 0:
+            key += self._size
+        if not 0 <= key < self._size:
+            raise IndexError("message index out of range")
+        return self._row(key)
+
+    def append(
+        self,
+        message_id: int,
+        message: str,
+        is_user: bool,
+        created_at: float,
+        tokens: int,
+        is_summary: bool = False,
+        is_duplicate: bool = False,
+    ):
+        """Add a message; `created_at` is in epoch seconds"""
+        if self._size == len(self._ids):
+            self._grow()
+        i = self._size
+        self._arena += message.encode("utf-8")
+        self._ids[i] = message_id
+        self._created_ms[i] = int(round(created_at * 1000))
+        self._tokens[i] = tokens
+        self._flags[i] = (
+            (IS_USER if is_user else 0) | (IS_SUMMARY if is_summary else 0) | (IS_DUPLICATE if is_duplicate else 0)
+        )
+        self._offsets[i + 1] = len(self._arena)
+        self._size += 1
+
+    def extend_from(self, other: "MessageTable", positions: np.ndarray):
+        """Copy the rows at `positions` of another table, in that order"""
+        for i in positions:
+            flags = other._flags[i]
+            self.append(
+                int(other._ids[i]),
+                other.text(i),
+                bool(flags & IS_USER),
+                int(other._created_ms[i]) / 1000.0,
+                int(other._tokens[i]),
+                is_summary=bool(flags & IS_SUMMARY),
+                is_duplicate=bool(flags & IS_DUPLICATE),
+            )
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self._size]
+
+    @property
+    def created_at(self) -> np.ndarray:
+        """Epoch seconds per row"""
+        return self._created_ms[:self._size] / 1000.0
+
+    @property
+    def tokens(self) -> np.ndarray:
+        return self._tokens[:self._size]
+
+    @property
+    def is_user(self) -> np.ndarray:
+        return (self._flags[:self._size] & IS_USER).astype(bool)
+
+    @property
+    def is_summary(self) -> np.ndarray:
+        return (self._flags[:self._size] & IS_SUMMARY).astype(bool)
+
+    @property
+    def is_duplicate(self) -> np.ndarray:
+        return (self._flags[:self._size] & IS_DUPLICATE).astype(bool)
+
+    def text(self, i: int) -> str:
+        return self._arena[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+    def nbytes(self) -> int:
+        """Approximate resident size of the table"""
+        columns = (self._ids, self._created_ms, self._tokens, self._flags, self._offsets)
+        return len(self._arena) + sum(column.nbytes for column in columns)
+
+    def _row(self, i: int) -> Dict:
+        created_at = int(self._created_ms[i]) / 1000.0
+        return {
+            "id": int(self._ids[i]),
+            "message": self.text(i),
+            "is_user": bool(self._flags[i] & IS_USER),
+            "is_summary": bool(self._flags[i] & IS_SUMMARY),
+            "is_duplicate": bool(self._flags[i] & IS_DUPLICATE),
+            "timestamp": datetime.fromtimestamp(created_at, tz=timezone.utc).isoformat(),
+            "created_at": created_at,
+            "tokens": int(self._tokens[i]),
+        }
+
+    def _grow(self):
+        capacity = max(len(self._ids) * 2, 16)
+        self._ids = np.resize(self._ids, capacity)
+        self._created_ms = np.resize(self._created_ms, capacity)
+        self._tokens = np.resize(self._tokens, capacity)
+        self._flags = np.resize(self._flags, capacity)
+        self._offsets = np.resize(self._offsets, capacity + 1)
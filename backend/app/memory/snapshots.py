@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import shutil
+import struct
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: generation writes are only serialized within one process
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<Q")
+
+
+def write_index_file(path: str, index: np.ndarray, meta: Dict):
+    """
+    Atomically write a serialized FAISS index with a JSON metadata header.
+    The data goes to a temporary file that is fsynced and then renamed over
+    `path`, so readers only ever see the old file or the complete new one.
+    """
+    header = json.dumps(meta).encode("utf-8")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(len(header)))
+        f.write(header)
+        f.write(index)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_index_file(path: str) -> Tuple[faiss.Index, Dict]:
+    """Read an index file written by write_index_file"""
+    with open(path, "rb") as f:
+        (header_size,) = _HEADER.unpack(f.read(_HEADER.size))
+        meta = json.loads(f.read(header_size).decode("utf-8"))
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    return faiss.deserialize_index(data), meta
+
+
+def serialize_index(index: faiss.Index) -> np.ndarray:
+    """
+    Copy an index into a uint8 array, which write_index_file writes without
+    another copy. This is a full copy of the index (about 0.8 GB and over a
+    second for 500k float32 vectors), so callers serialize one index at a time.
+    """
+    return faiss.serialize_index(index)
+
+
+def _link_or_copy(source: str, path: str):
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+class SnapshotDirectory:
+    """
+    Generations of shared-index snapshots under one directory.
+    - Each generation is a directory `gen-<last_id>` holding one file per
+      shard/promoted user plus a manifest written last. The manifest records
+      each file's metadata, including its own high-water message id.
+    - Files that did not change since the previous generation are hard-linked
+      from it instead of being serialized again.
+    - A generation is built under a temporary name and renamed into place,
+      so a crash never leaves a partially written generation visible.
+    - Workers sharing the directory take a file lock around each generation
+      write (including linking from `previous` and pruning), and temporary
+      names carry the writer's pid, so one never deletes another's work.
+    - Per-user snapshots (per-user mode) live in `users/`, one file each.
+    """
+
+    def __init__(self, path: str, keep: int = 2):
+        self.path = path
+        self.keep = keep
+        os.makedirs(os.path.join(path, "users"), exist_ok=True)
+
+    def user_path(self, key: str) -> str:
+        return os.path.join(self.path, "users", f"{key}.faiss")
+
+    def write_generation(
+        self,
+        last_id: int,
+        files: Iterable[Tuple[str, Optional[np.ndarray], Dict]],
+        manifest: Dict,
+        previous: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Write a complete generation of index files and its manifest.
+        `files` yields (filename, data, meta) and is consumed one file at a time,
+        so a generator can serialize each index just before it is written. A file
+        with data None is linked from the `previous` generation directory.
+        `files` is consumed under the directory lock, so it can check that
+        `previous` still exists before choosing to link from it.
+        Returns the new generation's directory, or None if it already existed.
+        """
+        name = f"gen-{last_id:020d}"
+        final_path = os.path.join(self.path, name)
+        with self._locked():
+            if os.path.exists(final_path):
+                return None
+            tmp_path = os.path.join(self.path, f".{name}.{os.getpid()}.tmp")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+
+            metas = {}
+            for filename, data, meta in files:
+                path = os.path.join(tmp_path, filename)
+                if data is None:
+                    _link_or_copy(os.path.join(previous, filename), path)
+                else:
+                    write_index_file(path, data, meta)
+                metas[filename] = meta
+            with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+                json.dump(dict(manifest, last_id=last_id, files=metas), f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp_path, final_path)
+            self._prune()
+        return final_path
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Exclusive lock on the directory, held across processes"""
+        with open(os.path.join(self.path, ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def latest_generation(self) -> Optional[Tuple[str, Dict]]:
+        """(directory, manifest) of the newest complete generation"""
+        for name in reversed(self._generations()):
+            directory = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(directory, "manifest.json")) as f:
+                    return directory, json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable snapshot {directory}: {str(e)}")
+        return None
+
+    def _generations(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.path) if name.startswith("gen-"))
+
+    def _prune(self):
+        """Drop old generations and this process's leftover temporary ones (call with the lock held)"""
+        for name in self._generations()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        for name in os.listdir(self.path):
+            if name.startswith(".gen-") and name.endswith(f".{os.getpid()}.tmp"):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
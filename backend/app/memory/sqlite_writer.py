@@ -0,0 +1,138 @@
+import logging
+import sqlite3
+import threading
+from typing import Callable, Iterable, List, Optional, Sequence
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# durability -> PRAGMA synchronous
+DURABILITY_LEVELS = {
+    "full": "FULL",
+    "normal": "NORMAL",
+    "off": "OFF",
+}
+
+
+class SQLiteWriter:
+    """
+    Long-lived, WAL-mode SQLite connection with group commit.
+    - One connection is shared by all threads and guarded by a lock; sqlite3's
+      statement cache keeps the fixed INSERT/SELECT statements prepared.
+    - Writes execute immediately (so row ids are known to the caller) inside an
+      open transaction. A background thread commits it every
+      `commit_interval_ms`, or as soon as `commit_max_rows` writes are pending.
+    - durability="full" commits and fsyncs every write, "normal" groups commits
+      with synchronous=NORMAL (a crash loses at most one commit interval) and
+      "off" also skips fsync entirely.
+    - `before_commit`, if set, runs right before every commit, e.g. to make
+      files the committed rows point into durable first.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        durability: str = "normal",
+        commit_interval_ms: float = 50.0,
+        commit_max_rows: int = 256,
+    ):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"durability must be one of {sorted(DURABILITY_LEVELS)}")
+
+        self.db_path = db_path
+        self.durability = durability
+        self.commit_interval_seconds = commit_interval_ms / 1000.0
+        self.commit_max_rows = commit_max_rows
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={DURABILITY_LEVELS[durability]}")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+
+        self.before_commit: Optional[Callable[[], None]] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._commits = 0
+        self._closed = threading.Event()
+
+        self._committer = threading.Thread(target=self._run, name="sqlite-group-commit", daemon=True)
+        self._committer.start()
+
+    def execute(self, sql: str, params: Sequence = ()) -> sqlite3.Cursor:
+        """Run a write statement and return its cursor (for lastrowid)"""
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._after_write(1)
+            return cursor
+
+    def executemany(self, sql: str, rows: Iterable[Sequence]) -> sqlite3.Cursor:
+        """Run a write statement once per row"""
+        with self._lock:
+            cursor = self._conn.executemany(sql, rows)
+            self._after_write(max(cursor.rowcount, 1))
+            return cursor
+
+    def insert_many(self, sql: str, rows: List[Sequence]) -> range:
+        """
+        Insert rows into an AUTOINCREMENT table and return their row ids.
+        The batch runs as one statement inside the open write transaction, which
+        holds SQLite's write lock, so the ids it allocates are contiguous.
+        """
+        with self._lock:
+            self._conn.executemany(sql, rows)
+            last_id = self._conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self._after_write(len(rows))
+            return range(last_id - len(rows) + 1, last_id + 1)
+
+    def query(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        """Run a read on the writer connection, which also sees uncommitted writes"""
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def open_reader(self) -> sqlite3.Connection:
+        """Open a separate connection for long streaming reads of committed data"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def flush(self):
+        """Commit any pending writes now"""
+        with self._lock:
+            self._commit()
+
+    def stats(self) -> dict:
+        """Group commit counters"""
+        with self._lock:
+            return {"durability": self.durability, "pending_writes": self._pending, "commits": self._commits}
+
+    def close(self):
+        """Commit pending writes and close the connection"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._committer.join()
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def _after_write(self, rows: int):
+        self._pending += rows
+        if self.durability == "full" or self._pending >= self.commit_max_rows:
+            self._commit()
+
+    def _commit(self):
+        if self._pending == 0 and not self._conn.in_transaction:
+            return
+        if self.before_commit is not None:
+            self.before_commit()
+        self._conn.commit()
+        self._pending = 0
+        self._commits += 1
+
+    def _run(self):
+        while not self._closed.wait(self.commit_interval_seconds):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Error committing SQLite writes: {str(e)}")
@@ -0,0 +1,61 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Iterable, List, Tuple, TypeVar
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Each "User: ..."/"Assistant: ..." context line costs its text plus a speaker prefix
+LINE_OVERHEAD_TOKENS = 3
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+
+T = TypeVar("T")
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+            _encoding = False
+    return _encoding or None
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """
+    Token count of a text for prompt budgeting.
+    Uses tiktoken's cl100k_base BPE when available (close to the Llama 3 and
+    Gemini tokenizers); otherwise estimates from words and punctuation.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Subword tokenizers average ~1.3 tokens per English word
+    return int(len(_WORD_PATTERN.findall(text)) * 1.3) + 1
+
+
+def pack_by_budget(ranked: Iterable[Tuple[T, int]], token_budget: int) -> List[T]:
+    """
+    Greedily take items in ranked order while their token costs fit the budget.
+    Items that do not fit are skipped so smaller, lower-ranked ones can still be used.
+    """
+    packed = []
+    remaining = token_budget
+    for item, tokens in ranked:
+        cost = tokens + LINE_OVERHEAD_TOKENS
+        if cost <= remaining:
+            packed.append(item)
+            remaining -= cost
+    return packed
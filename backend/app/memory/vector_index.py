@@ -0,0 +1,428 @@
+import itertools
+import logging
+import time
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+import faiss
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def shard_for(username: str, num_shards: int) -> int:
+    """Stable shard number for a username"""
+    return zlib.crc32(username.encode("utf-8")) % num_shards
+
+
+APPROXIMATE_KINDS = ("hnsw", "ivf")
+
+# codec -> FAISS scalar quantizer type (None keeps full float32 vectors)
+CODECS = {
+    "flat": None,
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+# Search-time knobs tried in order until the recall target is met
+HNSW_EF_SEARCH_STEPS = (16, 32, 64, 128, 256, 512)
+IVF_NPROBE_STEPS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Stored vectors needed before sq8 ranges are trained; fewer give a quantizer that clips later data
+SQ8_MIN_TRAINING_VECTORS = 1000
+
+
+def _recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(t[t >= 0], f[f >= 0])) for t, f in zip(truth, found))
+    return hits / max(int((truth >= 0).sum()), 1)
+
+
+def bytes_per_vector(vector_dim: int, codec: str) -> int:
+    """Size of one stored vector under a codec"""
+    return vector_dim * {"flat": 4, "fp16": 2, "sq8": 1}[codec]
+
+
+def new_flat_index(vector_dim: int, codec: str = "flat", trained: Optional[faiss.Index] = None) -> faiss.Index:
+    """Exhaustive-search index storing vectors with the given codec"""
+    if CODECS[codec] is None:
+        return faiss.IndexFlatL2(vector_dim)
+    if trained is not None:
+        return faiss.clone_index(trained)
+    return faiss.IndexScalarQuantizer(vector_dim, CODECS[codec], faiss.METRIC_L2)
+
+
+def measure_codec_recall(
+    vector_dim: int,
+    codec: str,
+    vectors: np.ndarray,
+    trained: Optional[faiss.Index] = None,
+    k: int = 10,
+    sample_size: int = 200,
+) -> float:
+    """recall@k of a codec against exact float32 search, on the given vectors"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, vector_dim)
+    if CODECS[codec] is None or len(vectors) < 2:
+        return 1.0
+
+    exact = faiss.IndexFlatL2(vector_dim)
+    exact.add(vectors)
+    compressed = new_flat_index(vector_dim, codec, trained)
+    if not compressed.is_trained:
+        compressed.train(vectors)
+    compressed.add(vectors)
+
+    queries = vectors[np.random.default_rng(0).choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+    k = min(k, len(vectors))
+    _, truth = exact.search(queries, k)
+    _, found = compressed.search(queries, k)
+    return _recall_at_k(truth, found)
+
+
+def build_approximate_index(
+    vector_dim: int,
+    ids: np.ndarray,
+    vectors: np.ndarray,
+    kind: str = "hnsw",
+    codec: str = "flat",
+    recall_target: float = 0.95,
+    k: int = 10,
+    sample_size: int = 200,
+    hnsw_m: int = 32,
+) -> Tuple[faiss.Index, Dict]:
+    """
+    Build an ID-mapped HNSW or IVF index and calibrate its search knob.
+    A sample of the indexed vectors is used as queries; efSearch (HNSW) or
+    nprobe (IVF) is raised until recall@k against exact search reaches
+    `recall_target`. Returns the index and a report of the chosen setting.
+    With a compressed codec the HNSW graph / IVF lists store quantized vectors.
+    """
+    if kind not in APPROXIMATE_KINDS:
+        raise ValueError(f"kind must be one of {APPROXIMATE_KINDS}")
+
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), vector_dim)
+
+    started = time.perf_counter()
+    qtype = CODECS[codec]
+    if kind == "hnsw":
+        if qtype is None:
+            inner = faiss.IndexHNSWFlat(vector_dim, hnsw_m)
+        else:
+            inner = faiss.IndexHNSWSQ(vector_dim, qtype, hnsw_m)
+            inner.train(vectors)
+        inner.hnsw.efConstruction = 80
+        steps = HNSW_EF_SEARCH_STEPS
+    else:
+        nlist = max(1, min(int(4 * np.sqrt(len(ids))), len(ids) // 39))
+        if qtype is None:
+            inner = faiss.IndexIVFFlat(faiss.IndexFlatL2(vector_dim), vector_dim, nlist)
+        else:
+            inner = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatL2(vector_dim), vector_dim, nlist, qtype)
+        inner.train(vectors)
+        steps = tuple(step for step in IVF_NPROBE_STEPS if step < nlist) + (nlist,)
+    index = faiss.IndexIDMap2(inner)
+    index.add_with_ids(vectors, ids)
+    build_seconds = time.perf_counter() - started
+
+    # Exact neighbours of a sample of the user's own vectors are the ground truth
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+    exact = faiss.IndexIDMap2(faiss.IndexFlatL2(vector_dim))
+    exact.add_with_ids(vectors, ids)
+    k = min(k, len(ids))
+    _, truth = exact.search(sample, k)
+
+    recall = 0.0
+    latency_ms = 0.0
+    for step in steps:
+        if kind == "hnsw":
+            inner.hnsw.efSearch = step
+        else:
+            inner.nprobe = step
+        started = time.perf_counter()
+        _, found = index.search(sample, k)
+        latency_ms = (time.perf_counter() - started) * 1000.0 / len(sample)
+        recall = _recall_at_k(truth, found)
+        if recall >= recall_target:
+            break
+
+    report = {
+        "kind": kind,
+        "codec": codec,
+        "vectors": len(ids),
+        "search_knob": "efSearch" if kind == "hnsw" else "nprobe",
+        "search_value": step,
+        "recall_at_k": recall,
+        "k": k,
+        "latency_ms_per_query": latency_ms,
+        "build_seconds": build_seconds,
+    }
+    if recall < recall_target:
+        logger.warning(f"Approximate index reached recall {recall:.3f}, below target {recall_target}")
+    return index, report
+
+
+class VectorIndex:
+    """
+    FAISS storage for the message embeddings of every user.
+    - FAISS ids are always the SQLite `messages.id` of the embedded message.
+    - Per-user mode keeps one ID-mapped flat index per username.
+    - Shared mode keeps every user in a small number of ID-mapped shards and
+      restricts a search to one user's message ids with an IDSelector, so memory
+      grows with the number of messages rather than the number of users.
+    - Heavy users can be promoted to a dedicated approximate index in either
+      mode; their vectors then leave the shared shard.
+    - `codec` selects float32 ("flat"), float16 ("fp16") or 8-bit scalar
+      quantized ("sq8") storage. sq8 is trained on real vectors only: until
+      `min_training_vectors` exist it stores fp16, and `retrain()` re-encodes.
+    - Every change to a shard or approximate index gets a new version number,
+      so snapshots can tell which indices changed since they were last written.
+    """
+
+    def __init__(
+        self,
+        vector_dim: int,
+        shared: bool = False,
+        num_shards: int = 1,
+        codec: str = "flat",
+        training_vectors: Optional[np.ndarray] = None,
+        min_training_vectors: int = SQ8_MIN_TRAINING_VECTORS,
+    ):
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1")
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {sorted(CODECS)}")
+
+        self.vector_dim = vector_dim
+        self.shared = shared
+        self.num_shards = num_shards
+        self.codec = codec
+        self.min_training_vectors = max(min_training_vectors, 1)
+        self._trained = self._train(training_vectors)
+        self._user_indices: Dict[str, faiss.Index] = {}
+        # Users whose dedicated index is an approximate (HNSW/IVF) structure
+        self._approximate: Set[str] = set()
+        self._shards: List[faiss.Index] = (
+            [self._new_index() for _ in range(num_shards)] if shared else []
+        )
+        self._changes = itertools.count(1)
+        self._shard_versions: List[int] = [0] * len(self._shards)
+        self._approximate_versions: Dict[str, int] = {}
+
+    def _train(self, training_vectors: Optional[np.ndarray]) -> Optional[faiss.Index]:
+        """Train the scalar quantizer; every new index clones the result (None while deferred)"""
+        if CODECS[self.codec] is None:
+            return None
+        template = new_flat_index(self.vector_dim, self.codec)
+        if template.is_trained:
+            return None
+        if training_vectors is None or len(training_vectors) < self.min_training_vectors:
+            logger.info(
+                f"Deferring {self.codec} training until {self.min_training_vectors} vectors are stored, "
+                "storing fp16 meanwhile"
+            )
+            return None
+        template.train(np.ascontiguousarray(training_vectors, dtype=np.float32).reshape(-1, self.vector_dim))
+        return template
+
+    @property
+    def storage_codec(self) -> str:
+        """Codec vectors are currently stored with: untrained sq8 falls back to fp16"""
+        if self.codec == "sq8" and self._trained is None:
+            return "fp16"
+        return self.codec
+
+    def needs_training(self) -> bool:
+        """Check if the configured codec is still waiting for training data"""
+        return self.storage_codec != self.codec
+
+    def retrain(self, training_vectors: np.ndarray) -> bool:
+        """
+        Train the deferred codec and re-encode every shard and per-user flat
+        index with it, from their fp16 copies.
+        Approximate indices train their own codec and are left alone.
+        Returns False if there are still too few training vectors.
+        """
+        if not self.needs_training():
+            return True
+        trained = self._train(training_vectors)
+        if trained is None:
+            return False
+        self._trained = trained
+
+        def reencode(index: faiss.Index) -> faiss.Index:
+            rebuilt = self._new_index()
+            if index.ntotal:
+                rebuilt.add_with_ids(index.index.reconstruct_n(0, index.ntotal), faiss.vector_to_array(index.id_map))
+            return rebuilt
+
+        for shard, index in enumerate(self._shards):
+            self._shards[shard] = reencode(index)
+            self._shard_versions[shard] = next(self._changes)
+        for username, index in list(self._user_indices.items()):
+            if username not in self._approximate:
+                self._user_indices[username] = reencode(index)
+        return True
+
+    def _new_index(self) -> faiss.Index:
+        return faiss.IndexIDMap2(new_flat_index(self.vector_dim, self.storage_codec, self._trained))
+
+    def measure_recall(self, vectors: np.ndarray, k: int = 10) -> float:
+        """recall@k of the codec vectors are stored with against exact search on sample vectors"""
+        return measure_codec_recall(self.vector_dim, self.storage_codec, vectors, trained=self._trained, k=k)
+
+    def shard_of(self, username: str) -> int:
+        """Shard holding a user's vectors"""
+        return shard_for(username, self.num_shards)
+
+    def _index_for(self, username: str, create: bool = False) -> Optional[faiss.Index]:
+        index = self._user_indices.get(username)
+        if index is None and self.shared:
+            return self._shards[self.shard_of(username)]
+        if index is None and create:
+            index = self._new_index()
+            self._user_indices[username] = index
+        return index
+
+    def _changed(self, username: str):
+        if username in self._approximate:
+            self._approximate_versions[username] = next(self._changes)
+        elif self.shared and username not in self._user_indices:
+            self._shard_versions[self.shard_of(username)] = next(self._changes)
+
+    def shard_version(self, shard: int) -> int:
+        """Version of a shared shard; changes whenever its vectors do"""
+        return self._shard_versions[shard]
+
+    def approximate_version(self, username: str) -> int:
+        """Version of a user's approximate index; changes whenever its vectors do"""
+        return self._approximate_versions.get(username, 0)
+
+    def has_user(self, username: str) -> bool:
+        """Check if vectors for a user are held by this index"""
+        return self.shared or username in self._user_indices
+
+    def ensure_user(self, username: str):
+        """Create the (empty) per-user index for a user if needed"""
+        self._index_for(username, create=True)
+
+    def add(self, username: str, ids: np.ndarray, vectors: np.ndarray):
+        """Add a batch of vectors for a user under the given message ids"""
+        ids = np.ascontiguousarray(ids, dtype=np.int64).reshape(-1)
+        if len(ids) == 0:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.vector_dim)
+        self._index_for(username, create=True).add_with_ids(vectors, ids)
+        self._changed(username)
+
+    def add_to_shard(self, shard: int, ids: np.ndarray, vectors: np.ndarray):
+        """Bulk-add vectors of any number of users directly to one shared shard"""
+        ids = np.ascontiguousarray(ids, dtype=np.int64).reshape(-1)
+        if len(ids) == 0:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.vector_dim)
+        self._shards[shard].add_with_ids(vectors, ids)
+        self._shard_versions[shard] = next(self._changes)
+
+    def remove(self, username: str, ids: np.ndarray) -> bool:
+        """
+        Remove a user's vectors by message id.
+        Returns False when the user's index cannot delete (HNSW); the caller
+        then has to rebuild it without those ids.
+        """
+        ids = np.ascontiguousarray(ids, dtype=np.int64).reshape(-1)
+        index = self._index_for(username)
+        if index is None or len(ids) == 0:
+            return True
+        try:
+            index.remove_ids(faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids)))
+        except RuntimeError:
+            return False
+        self._changed(username)
+        return True
+
+    def search(
+        self,
+        username: str,
+        queries: np.ndarray,
+        k: int,
+        user_ids: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search a user's vectors and return (distances, message ids).
+        In shared mode `user_ids` must list the user's message ids; missing
+        results are reported with id -1 as usual for FAISS.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.vector_dim)
+        index = self._index_for(username)
+        empty = (
+            np.empty((len(queries), 0), dtype=np.float32),
+            np.empty((len(queries), 0), dtype=np.int64),
+        )
+        if index is None or index.ntotal == 0 or k <= 0:
+            return empty
+
+        if username in self._user_indices:
+            return index.search(queries, min(k, index.ntotal))
+
+        if user_ids is None or len(user_ids) == 0:
+            return empty
+        user_ids = np.ascontiguousarray(user_ids, dtype=np.int64)
+        selector = faiss.IDSelectorBatch(len(user_ids), faiss.swig_ptr(user_ids))
+        params = faiss.SearchParameters(sel=selector)
+        return index.search(queries, min(k, len(user_ids)), params=params)
+
+    def is_approximate(self, username: str) -> bool:
+        """Check if a user has been promoted to an approximate index"""
+        return username in self._approximate
+
+    def install_approximate(self, username: str, index: faiss.Index, ids: np.ndarray):
+        """Make a prebuilt approximate index the user's index, covering `ids`"""
+        if self.shared and username not in self._user_indices:
+            ids = np.ascontiguousarray(ids, dtype=np.int64)
+            self._shards[self.shard_of(username)].remove_ids(
+                faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+            )
+            self._shard_versions[self.shard_of(username)] = next(self._changes)
+        self._user_indices[username] = index
+        self._approximate.add(username)
+        self._changed(username)
+
+    def shard_indexes(self) -> List[faiss.Index]:
+        """The shared shard indices, in shard order"""
+        return list(self._shards)
+
+    def approximate_indexes(self) -> Dict[str, faiss.Index]:
+        """Dedicated approximate indices by username"""
+        return {username: self._user_indices[username] for username in self._approximate}
+
+    def restore_shard(self, shard: int, index: faiss.Index):
+        """Replace a shard with an index loaded from a snapshot"""
+        self._shards[shard] = index
+        self._shard_versions[shard] = next(self._changes)
+
+    def restore_approximate(self, username: str, index: faiss.Index):
+        """Install an approximate index loaded from a snapshot (shards untouched)"""
+        self._user_indices[username] = index
+        self._approximate.add(username)
+        self._changed(username)
+
+    def drop_user(self, username: str):
+        """Release a user's per-user index (shared-mode vectors stay in place)"""
+        if self.shared:
+            return
+        self._user_indices.pop(username, None)
+        self._approximate.discard(username)
+        self._approximate_versions.pop(username, None)
+
+    def ntotal(self) -> int:
+        """Total number of vectors held across all indices"""
+        return sum(index.ntotal for index in self._shards) + sum(
+            index.ntotal for index in self._user_indices.values()
+        )
+
+    def approximate_count(self) -> int:
+        """Number of users served by an approximate index"""
+        return len(self._approximate)
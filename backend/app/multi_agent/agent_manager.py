@@ -9,12 +9,16 @@ from ..llm.gemini_client import GeminiClient
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tokens of conversation history packed into an agent's prompt
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1024
+
 class AgentProfile(BaseModel):
     """Agent profile with specific characteristics"""
     name: str
     role: str
     description: str
     system_prompt: str
+    context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET
 
 class AgentManager:
     """Manages multiple AI agents with different roles"""
@@ -38,7 +42,8 @@ class AgentManager:
             You are a helpful, concise assistant. 
             Provide clear answers, step-by-step instructions when useful, and ask one clarifying question if the request is ambiguous. 
             Keep responses under ~300 words unless the user asks for more.
-            """
+            """,
+            context_token_budget=768
         )
         
         # Technical Assistant
@@ -51,7 +56,8 @@ class AgentManager:
             Prioritize correct code examples, minimal reproducible snippets, and explain trade-offs. 
             When giving commands, mark them in code blocks. 
             Ask for environment details (OS, language version, frameworks) if missing.
-            """
+            """,
+            context_token_budget=2048
         )
         
         # Creative Writer
@@ -92,13 +98,21 @@ class AgentManager:
             """
         )
     
-    def register_agent(self, name: str, role: str, description: str, system_prompt: str):
+    def register_agent(
+        self,
+        name: str,
+        role: str,
+        description: str,
+        system_prompt: str,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET
+    ):
         """Register a new agent profile"""
         self.agents[name] = AgentProfile(
             name=name,
             role=role,
             description=description,
-            system_prompt=system_prompt
+            system_prompt=system_prompt,
+            context_token_budget=context_token_budget
         )
         logger.info(f"Registered agent: {name} ({role})")
     
@@ -154,13 +168,13 @@ class AgentManager:
             return "Handoff failed. One or both agents not found."
         
         # Get context from memory
-        context = self.memory_store.get_context_for_user(username)
+        context = await self.memory_store.abuild_context(username, target_agent.context_token_budget)
         
         # Generate handoff message
         handoff_message = f"I'm transferring you to our {target_agent.role} who can better assist you with this. {reason}"
         
         # Store the handoff message
-        self.memory_store.add_message(username, handoff_message, is_user=False)
+        await self.memory_store.aadd_message(username, handoff_message, is_user=False)
         
         # Generate welcome message from the new agent
         welcome_prompt = f"""
@@ -1,18 +1,29 @@
 import os
+import time
+import asyncio
 import logging
 import uvicorn
+import httpx
 import sqlite3
 import numpy as np
 import json
+import threading
+import uuid
+from collections import OrderedDict
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, List, Optional
-from groq import Groq
+from typing import AsyncIterator, Dict, List, Optional, Set
+from groq import AsyncGroq, Groq
 from langchain_groq import ChatGroq
 from dotenv import load_dotenv
 from mem0 import MemoryClient
 
+from app.memory.compaction import build_summary_prompt
+from app.memory.context_buffer import ContextBuffer
+from app.memory.token_counter import LINE_OVERHEAD_TOKENS, count_tokens, pack_by_budget
+
 # Load environment variables
 load_dotenv()
 
@@ -24,7 +35,28 @@ logger = logging.getLogger(__name__)
 groq_api_key = os.getenv("GROQ_API_KEY")
 if not groq_api_key:
     raise ValueError("GROQ_API_KEY environment variable not set")
-groq_client = Groq(api_key=groq_api_key)
+# Chat requests use the async client so an LLM round-trip never blocks the event loop.
+# One pooled HTTP client is shared by every request; the semaphore caps in-flight calls.
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "16"))
+GROQ_TIMEOUT_SECONDS = float(os.getenv("GROQ_TIMEOUT_SECONDS", "30"))
+GROQ_CONNECT_TIMEOUT_SECONDS = float(os.getenv("GROQ_CONNECT_TIMEOUT_SECONDS", "5"))
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "2"))
+groq_timeout = httpx.Timeout(GROQ_TIMEOUT_SECONDS, connect=GROQ_CONNECT_TIMEOUT_SECONDS)
+async_groq_client = AsyncGroq(
+    api_key=groq_api_key,
+    timeout=groq_timeout,
+    max_retries=GROQ_MAX_RETRIES,
+    http_client=httpx.AsyncClient(
+        timeout=groq_timeout,
+        limits=httpx.Limits(
+            max_connections=GROQ_MAX_CONCURRENCY,
+            max_keepalive_connections=GROQ_MAX_CONCURRENCY,
+        ),
+    ),
+)
+groq_semaphore = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+# Blocking client for background jobs that already run in a worker thread
+groq_client = Groq(api_key=groq_api_key, timeout=groq_timeout, max_retries=GROQ_MAX_RETRIES)
 
 # Initialize Mem0 client
 mem0_api_key = os.getenv("MEM0_API_KEY", "m0-BIIaaD4yTCeKto4g3R9piQHwUvbWkvYAixCaCj2k")
@@ -95,66 +127,194 @@ class HandoffRequest(BaseModel):
     to_agent: str
     reason: str = ""
 
+# Memories fetched per search; the agent's token budget decides how many reach the prompt
+CONTEXT_SEARCH_LIMIT = 20
+
 # Agent profiles
 AGENTS = {
     "general-assistant": {
         "name": "General Assistant",
         "role": "Helpful Assistant",
         "description": "A helpful, concise assistant providing clear answers",
-        "prompt": "You are a helpful, concise assistant. Provide clear answers, step-by-step instructions when useful, and ask one clarifying question if the request is ambiguous. Keep responses under ~300 words unless the user asks for more."
+        "prompt": "You are a helpful, concise assistant. Provide clear answers, step-by-step instructions when useful, and ask one clarifying question if the request is ambiguous. Keep responses under ~300 words unless the user asks for more.",
+        "context_tokens": 768
     },
     "technical-assistant": {
         "name": "Technical Assistant",
         "role": "Developer Assistant",
         "description": "Expert developer assistant providing code examples and technical advice",
-        "prompt": "You are an expert developer assistant. Prioritize correct code examples, minimal reproducible snippets, and explain trade-offs. When giving commands, mark them in code blocks. Ask for environment details (OS, language version, frameworks) if missing."
+        "prompt": "You are an expert developer assistant. Prioritize correct code examples, minimal reproducible snippets, and explain trade-offs. When giving commands, mark them in code blocks. Ask for environment details (OS, language version, frameworks) if missing.",
+        "context_tokens": 2048
     },
     "creative-writer": {
         "name": "Creative Writer",
         "role": "Creative Assistant",
         "description": "Creative writing assistant producing vivid, original text",
-        "prompt": "You are a creative writing assistant. Produce vivid, original text in the requested tone and length. If the user does not specify tone or POV, ask which they prefer. Avoid clichés and keep language fresh."
+        "prompt": "You are a creative writing assistant. Produce vivid, original text in the requested tone and length. If the user does not specify tone or POV, ask which they prefer. Avoid clichés and keep language fresh.",
+        "context_tokens": 1024
     },
     "fact-checker": {
         "name": "Fact Checker",
         "role": "Research Assistant",
         "description": "Careful fact-checker verifying claims with sources",
-        "prompt": "You are a careful fact-checker. Verify claims, list the confidence level, and provide 2–3 concise sources or suggestions where to look. If unsure, say so explicitly and propose next steps to verify."
+        "prompt": "You are a careful fact-checker. Verify claims, list the confidence level, and provide 2–3 concise sources or suggestions where to look. If unsure, say so explicitly and propose next steps to verify.",
+        "context_tokens": 1024
     },
     "tutor": {
         "name": "Tutor",
         "role": "Educational Assistant",
         "description": "Patient tutor explaining concepts with examples",
-        "prompt": "You are a patient tutor. Explain concepts step-by-step, use simple analogies, give a single short example, and then offer a small practice problem the user can try. Ask if they'd like a deeper dive."
+        "prompt": "You are a patient tutor. Explain concepts step-by-step, use simple analogies, give a single short example, and then offer a small practice problem the user can try. Ask if they'd like a deeper dive.",
+        "context_tokens": 1024
     }
 }
 
-# Helper functions using Mem0
-def user_exists(username: str) -> bool:
-    """Check if a user exists in Mem0"""
-    try:
-        # According to Mem0 API docs, we need to use proper filters
-        # Using v2 search API with user_id filter
-        filters = {"user_id": username}
-        
-        # Search for any memories for this user
-        results = mem0_client.search(
-            query="user check",  # Non-empty query required
-            version="v2",        # Using v2 API as recommended
-            filters=filters,
-            limit=1
-        )
+# Pre-rendered recent context per user, warmed from Mem0 on first use and
+# then kept current by add_message so later turns skip the search entirely
+CONTEXT_BUFFER_MAX_USERS = int(os.getenv("CONTEXT_BUFFER_MAX_USERS", "10000"))
+CONTEXT_BUFFER_TTL_SECONDS = float(os.getenv("CONTEXT_BUFFER_TTL_SECONDS", "600"))
+CONTEXT_BUFFER_FALLBACK_TTL_SECONDS = float(os.getenv("CONTEXT_BUFFER_FALLBACK_TTL_SECONDS", "30"))
+
+class ContextBuffers:
+    """
+    Per-user ContextBuffers, bounded and periodically re-seeded.
+    - An LRU of at most `max_users` buffers.
+    - get() stops returning a buffer once it is older than its TTL, so the next
+      context() re-seeds it from Mem0. Buffers seeded from the SQLite fallback
+      get a short TTL, so one failed search does not pin them.
+    - The map has its own lock and every ContextBuffer locks itself, so buffers
+      can be used from the event loop and from worker threads at once.
+    """
+    
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._buffers: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, username: str) -> Optional[ContextBuffer]:
+        """The user's buffer, or None if there is none or it is due for a refresh"""
+        with self._lock:
+            entry = self._buffers.get(username)
+            if entry is None or time.monotonic() >= entry[1]:
+                return None
+            self._buffers.move_to_end(username)
+            return entry[0]
+    
+    def discard(self, username: str):
+        """Drop the user's buffer so the next context() re-seeds it"""
+        with self._lock:
+            self._buffers.pop(username, None)
+    
+    def put(self, username: str, buffer: ContextBuffer, ttl_seconds: float):
+        with self._lock:
+            self._buffers[username] = (buffer, time.monotonic() + ttl_seconds)
+            self._buffers.move_to_end(username)
+            while len(self._buffers) > self.max_users:
+                self._buffers.popitem(last=False)
+
+context_buffers = ContextBuffers(max_users=CONTEXT_BUFFER_MAX_USERS)
+
+# Background folding of old Mem0 turns into a rolling summary (0 disables).
+# Folded turns are archived in data/memory.db before they are deleted from Mem0.
+MEM0_COMPACT_AFTER = int(os.getenv("MEM0_COMPACT_AFTER", "0"))
+MEM0_COMPACT_KEEP_RECENT = int(os.getenv("MEM0_COMPACT_KEEP_RECENT", "50"))
+MEM0_COMPACT_INTERVAL_SECONDS = float(os.getenv("MEM0_COMPACT_INTERVAL_SECONDS", "600"))
+# Minimum gap between summarization calls, and quiet time required before one
+MEM0_COMPACT_MIN_GAP_SECONDS = float(os.getenv("MEM0_COMPACT_MIN_GAP_SECONDS", "10"))
+MEM0_COMPACT_IDLE_SECONDS = float(os.getenv("MEM0_COMPACT_IDLE_SECONDS", "5"))
+last_activity = time.monotonic()
+# Users who added turns since the last compaction pass
+compaction_candidates: Set[str] = set()
+
+# Local presence index so "does this user exist" rarely needs a Mem0 search
+KNOWN_USER_TTL_SECONDS = float(os.getenv("KNOWN_USER_TTL_SECONDS", "3600"))
+KNOWN_USER_NEGATIVE_TTL_SECONDS = float(os.getenv("KNOWN_USER_NEGATIVE_TTL_SECONDS", "60"))
+KNOWN_USER_CACHE_SIZE = int(os.getenv("KNOWN_USER_CACHE_SIZE", "100000"))
+
+class KnownUsers:
+    """
+    Which users exist, answered from memory and the SQLite users table.
+    - Entries expire after `ttl_seconds` (known users) or `negative_ttl_seconds`
+      (users not found), then are refreshed from SQLite; only a user missing
+      locally costs a Mem0 lookup.
+    - mark() records a user in memory on every write and never blocks, so it is
+      safe on the event loop; persist() then adds them to the users table from
+      the thread that writes their turns.
+    - The in-memory part is an LRU bounded to `max_entries` users.
+    """
+    
+    def __init__(self, ttl_seconds: float = 3600.0, negative_ttl_seconds: float = 60.0, max_entries: int = 100000):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def lookup(self, username: str) -> Optional[bool]:
+        """Whether the user exists, or None if only Mem0 can tell"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and time.monotonic() < entry[1]:
+                self._entries.move_to_end(username)
+                return entry[0]
         
-        return len(results) > 0
-    except Exception as e:
-        logger.error(f"Error checking if user exists in Mem0: {str(e)}")
-        # Fall back to SQLite
+        # Refresh from the local users table
         conn = sqlite3.connect("data/memory.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-        exists = cursor.fetchone() is not None
+        known = conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
         conn.close()
-        return exists
+        if known:
+            self._remember(username, True, self.ttl_seconds, persisted=True)
+            return True
+        return None
+    
+    def record(self, username: str, exists: bool):
+        """Remember the answer of a remote lookup"""
+        if exists:
+            self.mark(username)
+            self.persist(username)
+            return
+        self._remember(username, False, self.negative_ttl_seconds)
+    
+    def mark(self, username: str):
+        """Record that the user exists (they are being written); memory only"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] and time.monotonic() < entry[1]:
+                return
+        self._remember(username, True, self.ttl_seconds)
+    
+    def persist(self, username: str):
+        """Add a marked user to the users table unless already done; blocks on SQLite"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[2]:
+                return
+        conn = sqlite3.connect("data/memory.db")
+        conn.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+        conn.commit()
+        conn.close()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0]:
+                self._entries[username] = (True, entry[1], True)
+    
+    def _remember(self, username: str, exists: bool, ttl_seconds: float, persisted: bool = False):
+        with self._lock:
+            self._entries[username] = (exists, time.monotonic() + ttl_seconds, persisted)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+known_users = KnownUsers(
+    ttl_seconds=KNOWN_USER_TTL_SECONDS,
+    negative_ttl_seconds=KNOWN_USER_NEGATIVE_TTL_SECONDS,
+    max_entries=KNOWN_USER_CACHE_SIZE
+)
+
+# Helper functions using Mem0
+def user_exists(username: str) -> bool:
+    """Check if a user exists, asking Mem0 only when the local index cannot tell"""
+    return MemorySession(username, limit=1).exists()
 
 def initialize_user(username: str):
     """Initialize a user in Mem0"""
@@ -176,41 +336,15 @@ def initialize_user(username: str):
             logger.info(f"User {username} initialized in Mem0")
         except Exception as e:
             logger.error(f"Error initializing user in Mem0: {str(e)}")
-            # Fall back to SQLite
-            conn = sqlite3.connect("data/memory.db")
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
-            conn.commit()
-            conn.close()
+        # Also records the user in the SQLite fallback
+        known_users.mark(username)
+        known_users.persist(username)
 
 def add_message(username: str, message: str, is_user: bool):
     """Add a message to Mem0"""
-    try:
-        # Format the message for Mem0 according to API docs
-        role = "user" if is_user else "assistant"
-        messages = [{"role": role, "content": message}]
-        
-        # Add to Mem0 with proper parameters
-        # Use store_raw=True to prevent automatic summarization
-        mem0_client.add(
-            messages=messages,
-            user_id=username,
-            version="v2",  # Using v2 API as recommended
-            store_raw=True  # Store raw messages without summarization
-        )
-        
-        logger.info(f"Message added to Mem0 for user {username}: {role} - {message[:50]}...")
-    except Exception as e:
-        logger.error(f"Error adding message to Mem0: {str(e)}")
-        # Fall back to SQLite
-        conn = sqlite3.connect("data/memory.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO messages (username, message, is_user) VALUES (?, ?, ?)",
-            (username, message, is_user)
-        )
-        conn.commit()
-        conn.close()
+    session = MemorySession(username)
+    session.add(message, is_user)
+    session.commit()
 
 def get_all_messages_for_user(username: str) -> list:
     """Get all messages for a user from Mem0"""
@@ -245,159 +379,625 @@ def get_all_messages_for_user(username: str) -> list:
         
         return messages
 
-def get_context_for_user(username: str, limit: int = 10) -> str:
-    """Get context for a user from Mem0"""
-    try:
-        # Using v2 search API to get relevant context
-        filters = {"user_id": username}
-        
-        # Search for relevant memories
-        # We use a generic query to get recent memories
-        results = mem0_client.search(
-            query="recent conversation",
-            version="v2",
-            filters=filters,
-            limit=limit
-        )
-        
-        
-        # Format the context
-        context = ""
-        if results:
-            for item in results:
-                # Extract memory content
-                if isinstance(item, dict) and "memory" in item:
-                    memory_content = item["memory"]
-                    
-                    # Try to parse the memory to extract role and content
-                    try:
-                        memory_data = json.loads(memory_content)
-                        if isinstance(memory_data, dict):
-                            role = memory_data.get("role", "unknown")
-                            content = memory_data.get("content", memory_content)
-                            speaker = "User" if role == "user" else "Assistant"
-                            context += f"{speaker}: {content}\n"
-                        else:
-                            context += f"{memory_content}\n"
-                    except:
-                        # If parsing fails, check if it's a raw message format
-                        if "User:" in memory_content or "Assistant:" in memory_content:
-                            context += f"{memory_content}\n"
-                        else:
-                            # Try to infer role from content
-                            if "user" in memory_content.lower() and "likes" in memory_content.lower():
-                                context += f"User: {memory_content}\n"
-                            else:
-                                context += f"Assistant: {memory_content}\n"
+def _context_lines(results) -> List[str]:
+    """Mem0 search results as "User: ..."/"Assistant: ..." lines, most relevant first"""
+    lines = []
+    for item in results or []:
+        # Extract memory content
+        if isinstance(item, dict) and "memory" in item:
+            memory_content = item["memory"]
+            
+            # Try to parse the memory to extract role and content
+            try:
+                memory_data = json.loads(memory_content)
+                if isinstance(memory_data, dict):
+                    role = memory_data.get("role", "unknown")
+                    content = memory_data.get("content", memory_content)
+                    speaker = "User" if role == "user" else "Assistant"
+                    lines.append(f"{speaker}: {content}\n")
                 else:
-                    # Handle case where memory is directly in the item
-                    if isinstance(item, dict) and "content" in item:
-                        content = item.get("content", "")
-                        role = item.get("role", "assistant")
-                        speaker = "User" if role == "user" else "Assistant"
-                        context += f"{speaker}: {content}\n"
-        
-        return context
-    except Exception as e:
-        logger.error(f"Error getting context from Mem0: {str(e)}")
-        # Fall back to SQLite
-        conn = sqlite3.connect("data/memory.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT message, is_user FROM messages WHERE username = ? ORDER BY timestamp DESC LIMIT ?",
-            (username, limit)
-        )
-        messages = cursor.fetchall()
-        conn.close()
-        
-        # Format the context
-        context = ""
-        for message, is_user in reversed(messages):
-            speaker = "User" if is_user else "Assistant"
-            context += f"{speaker}: {message}\n"
-        
-        return context
+                    lines.append(f"{memory_content}\n")
+            except:
+                # If parsing fails, check if it's a raw message format
+                if "User:" in memory_content or "Assistant:" in memory_content:
+                    lines.append(f"{memory_content}\n")
+                else:
+                    # Try to infer role from content
+                    if "user" in memory_content.lower() and "likes" in memory_content.lower():
+                        lines.append(f"User: {memory_content}\n")
+                    else:
+                        lines.append(f"Assistant: {memory_content}\n")
+        else:
+            # Handle case where memory is directly in the item
+            if isinstance(item, dict) and "content" in item:
+                content = item.get("content", "")
+                role = item.get("role", "assistant")
+                speaker = "User" if role == "user" else "Assistant"
+                lines.append(f"{speaker}: {content}\n")
+    return lines
 
-async def generate_response(message: str, username: str, agent_name: str = "general-assistant", context: Optional[str] = None) -> str:
-    try:
-        # Get agent profile
-        agent = AGENTS.get(agent_name, AGENTS["general-assistant"])
-        
-        # Prepare the user message
-        user_message = f"User: {message}"
-        
-        # Get recent conversation history from Mem0 for this user
-        # We'll prepare messages directly in the format Groq expects
-        messages = [
-            {"role": "system", "content": agent['prompt']}
+def _history_turns(results) -> List[Dict]:
+    """Mem0 search results as Groq chat messages, most relevant first"""
+    history = []
+    for item in results or []:
+        # Extract memory content
+        if isinstance(item, dict) and "memory" in item:
+            memory_content = item["memory"]
+            
+            # Try to parse the memory
+            try:
+                memory_data = json.loads(memory_content)
+                if isinstance(memory_data, dict):
+                    role = memory_data.get("role", "")
+                    content = memory_data.get("content", "")
+                    
+                    # Only add valid roles (user or assistant) and non-empty content
+                    if role in ["user", "assistant"] and content and content.strip():
+                        history.append({"role": role, "content": content.strip()})
+            except:
+                # Skip invalid memories
+                pass
+        else:
+            # Handle direct content format
+            if isinstance(item, dict) and "content" in item:
+                content = item.get("content", "")
+                role = item.get("role", "assistant")
+                if role in ["user", "assistant"] and content and content.strip():
+                    history.append({"role": role, "content": content.strip()})
+    return history
+
+class MemorySession:
+    """
+    Mem0 access for one request or chat turn: at most one read and one write.
+    - The first of exists()/context()/history() runs a single search; the rest
+      reuse its results (a failed search is not retried, they fall back instead).
+    - add() only queues a turn and updates the context buffer; commit() writes
+      every queued turn in one Mem0 call, which also establishes a new user.
+    - Mem0 is a blocking client, so async handlers run search()/commit() in a thread.
+    """
+    
+    def __init__(self, username: str, limit: int = CONTEXT_SEARCH_LIMIT):
+        self.username = username
+        self.limit = limit
+        self._results: Optional[list] = None
+        self._error: Optional[Exception] = None
+        self._pending: List[Dict] = []
+    
+    def search(self) -> list:
+        """The session's one Mem0 read"""
+        if self._error is not None:
+            raise self._error
+        if self._results is None:
+            try:
+                # We use a generic query to get recent memories
+                self._results = mem0_client.search(
+                    query="recent conversation",
+                    version="v2",
+                    filters={"user_id": self.username},
+                    limit=self.limit
+                ) or []
+            except Exception as e:
+                self._error = e
+                raise
+        return self._results
+    
+    def exists(self) -> bool:
+        """Whether the user has any memories; searches Mem0 only if the local index cannot tell"""
+        known = known_users.lookup(self.username)
+        if known is not None:
+            return known
+        try:
+            exists = len(self.search()) > 0
+        except Exception as e:
+            logger.error(f"Error checking if user exists in Mem0: {str(e)}")
+            # Not in the local users table either
+            return False
+        known_users.record(self.username, exists)
+        return exists
+    
+    def history(self) -> List[Dict]:
+        """Past turns found by Mem0 as Groq chat messages, most relevant first (see recent())"""
+        try:
+            found = _history_turns(self.search())
+        except Exception as e:
+            logger.warning(f"Error retrieving memory context: {str(e)}")
+            # Continue without context rather than failing
+            return []
+        seen = {(turn["role"], turn["content"]) for turn in self.recent()}
+        return [turn for turn in found if (turn["role"], turn["content"]) not in seen]
+    
+    def recent(self) -> List[Dict]:
+        """Turns still waiting in the write-behind queue (invisible to Mem0's search), oldest first"""
+        return [
+            {"role": turn["role"], "content": turn["content"].strip()}
+            for turn in mem0_writer.pending(self.username)
+            if turn["role"] in ["user", "assistant"] and turn["content"] and turn["content"].strip()
         ]
+    
+    def context(self, token_budget: int = 1024) -> str:
+        """Context packed into `token_budget` tokens, warming the user's context buffer"""
+        buffer = context_buffers.get(self.username)
+        if buffer is not None:
+            return buffer.pack(token_budget)
         
-        # Get conversation context from memory
         try:
-            # Get memories for this user to build conversation history
-            filters = {"user_id": username}
-            recent_messages = mem0_client.search(
-                query="recent conversation",
-                version="v2",
-                filters=filters,
-                limit=8  # Limit to recent messages to avoid token limits
+            lines = _context_lines(self.search())
+            
+            # Least relevant first, so packing the buffer newest-first keeps the best memories;
+            # turns still queued for Mem0 are the newest of all
+            buffer = ContextBuffer()
+            for line in reversed(lines):
+                buffer.append_line(line, count_tokens(line))
+            for turn in mem0_writer.pending(self.username):
+                buffer.append(turn["content"], turn["role"] == "user", count_tokens(turn["content"]))
+            context_buffers.put(self.username, buffer, CONTEXT_BUFFER_TTL_SECONDS)
+            return buffer.pack(token_budget)
+        except Exception as e:
+            logger.error(f"Error getting context from Mem0: {str(e)}")
+            # Fall back to SQLite
+            conn = sqlite3.connect("data/memory.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT message, is_user FROM messages WHERE username = ? ORDER BY timestamp DESC LIMIT ?",
+                (self.username, self.limit)
             )
+            messages = cursor.fetchall()
+            conn.close()
             
+            # Seed the buffer oldest first; packing keeps the newest messages that fit
+            buffer = ContextBuffer()
+            for message, is_user in reversed(messages):
+                buffer.append(message, is_user, count_tokens(message))
+            context_buffers.put(self.username, buffer, CONTEXT_BUFFER_FALLBACK_TTL_SECONDS)
             
-            # Format messages for Groq
-            if recent_messages:
-                for item in recent_messages:
-                    # Extract memory content
-                    if isinstance(item, dict) and "memory" in item:
-                        memory_content = item["memory"]
-                        
-                        # Try to parse the memory
-                        try:
-                            memory_data = json.loads(memory_content)
-                            if isinstance(memory_data, dict):
-                                role = memory_data.get("role", "")
-                                content = memory_data.get("content", "")
-                                
-                                # Only add valid roles (user or assistant) and non-empty content
-                                if role in ["user", "assistant"] and content and content.strip():
-                                    messages.append({"role": role, "content": content.strip()})
-                        except:
-                            # Skip invalid memories
-                            pass
-                    else:
-                        # Handle direct content format
-                        if isinstance(item, dict) and "content" in item:
-                            content = item.get("content", "")
-                            role = item.get("role", "assistant")
-                            if role in ["user", "assistant"] and content and content.strip():
-                                messages.append({"role": role, "content": content.strip()})
-        except Exception as mem_err:
-            logger.warning(f"Error retrieving memory context: {str(mem_err)}")
-            # Continue without context rather than failing
-        
-        # Always add the current message at the end
-        messages.append({"role": "user", "content": message})
-        
+            return buffer.pack(token_budget)
+    
+    def add(self, message: str, is_user: bool):
+        """Queue a turn for commit()"""
+        global last_activity
+        last_activity = time.monotonic()
+        compaction_candidates.add(self.username)
+        buffer = context_buffers.get(self.username)
+        if buffer is not None:
+            buffer.append(message, is_user, count_tokens(message))
+        self._pending.append({"role": "user" if is_user else "assistant", "content": message})
+        known_users.mark(self.username)
+    
+    def commit(self):
+        """Write the queued turns in one Mem0 call"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            _write_to_mem0(self.username, pending)
+            logger.info(f"Added {len(pending)} messages to Mem0 for user {self.username}")
+        except Exception as e:
+            logger.error(f"Error adding messages to Mem0: {str(e)}")
+            _spill_to_sqlite(self.username, pending)
+    
+    def commit_later(self):
+        """Hand the queued turns to the write-behind queue; must run on the event loop"""
+        if self._pending:
+            pending, self._pending = self._pending, []
+            mem0_writer.enqueue(self.username, pending)
+
+def _write_to_mem0(username: str, messages: List[Dict]):
+    """One Mem0 add for a user's turns, then the user's row in the local users table"""
+    # Use store_raw=True to prevent automatic summarization
+    mem0_client.add(
+        messages=messages,
+        user_id=username,
+        version="v2",
+        store_raw=True
+    )
+    try:
+        known_users.persist(username)
+    except Exception as e:
+        # The turns are in Mem0; only the local presence index missed them
+        logger.warning(f"Error recording {username} in the local users table: {str(e)}")
+
+def _spill_to_sqlite(username: str, messages: List[Dict]):
+    """Store Mem0-format messages in the local SQLite fallback"""
+    conn = sqlite3.connect("data/memory.db")
+    conn.execute("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+    conn.executemany(
+        "INSERT INTO messages (username, message, is_user) VALUES (?, ?, ?)",
+        [(username, turn["content"], turn["role"] == "user") for turn in messages]
+    )
+    conn.commit()
+    conn.close()
+
+def get_context_for_user(username: str, token_budget: int = 1024, limit: int = CONTEXT_SEARCH_LIMIT) -> str:
+    """Get context for a user from Mem0, packed into `token_budget` tokens"""
+    return MemorySession(username, limit).context(token_budget)
+
+# Write-behind for Mem0 adds, so reply latency never includes memory writes
+MEM0_WRITE_QUEUE_SIZE = int(os.getenv("MEM0_WRITE_QUEUE_SIZE", "1000"))
+MEM0_WRITE_BATCH = int(os.getenv("MEM0_WRITE_BATCH", "50"))
+MEM0_WRITE_CONCURRENCY = int(os.getenv("MEM0_WRITE_CONCURRENCY", "4"))
+MEM0_WRITE_RETRIES = int(os.getenv("MEM0_WRITE_RETRIES", "3"))
+MEM0_WRITE_BACKOFF_SECONDS = float(os.getenv("MEM0_WRITE_BACKOFF_SECONDS", "0.5"))
+MEM0_WRITE_DRAIN_SECONDS = float(os.getenv("MEM0_WRITE_DRAIN_SECONDS", "10"))
+
+class Mem0WriteBehind:
+    """
+    Background writer that takes Mem0 adds off the request path.
+    - enqueue() never waits: when the queue is full the turn is written to the
+      SQLite fallback by a background task instead.
+    - Each pass takes up to `batch_size` queued turns and merges them per user
+      into one add call. Mem0 adds are per user, so different users are written
+      concurrently (at most `concurrency` calls) rather than in one request.
+    - Failed adds are retried with exponential backoff, then spilled to SQLite.
+    - Turns are tracked per user until written or spilled, so pending() can show
+      them to prompts and drain() can spill batches cancelled mid-write.
+    - drain() flushes the queue on shutdown; whatever is left is spilled.
+    """
+    
+    def __init__(
+        self,
+        queue_size: int = 1000,
+        batch_size: int = 50,
+        concurrency: int = 4,
+        retries: int = 3,
+        backoff_seconds: float = 0.5
+    ):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._overflow: Set[asyncio.Task] = set()
+        # Queued and in-flight turns per user, oldest first; read from worker threads
+        self._unwritten: Dict[str, List[Dict]] = {}
+        self._unwritten_lock = threading.Lock()
+        self._stats = {"queued": 0, "calls": 0, "written": 0, "retries": 0, "spilled": 0}
+    
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+    
+    def stats(self) -> Dict:
+        return dict(self._stats, queue_depth=self._queue.qsize() if self._queue else 0)
+    
+    def pending(self, username: str) -> List[Dict]:
+        """The user's turns not yet written to Mem0, oldest first"""
+        with self._unwritten_lock:
+            return list(self._unwritten.get(username, ()))
+    
+    def enqueue(self, username: str, messages: List[Dict]):
+        """Queue one turn's messages for a single add call"""
+        self.start()
+        try:
+            self._queue.put_nowait((username, messages))
+            with self._unwritten_lock:
+                self._unwritten.setdefault(username, []).extend(messages)
+            self._stats["queued"] += len(messages)
+        except asyncio.QueueFull:
+            logger.warning(f"Mem0 write queue full, storing {len(messages)} messages for {username} locally")
+            # SQLite blocks, so even the overflow path stays off the event loop
+            task = asyncio.create_task(self._spill(username, messages))
+            self._overflow.add(task)
+            task.add_done_callback(self._overflow.discard)
+    
+    async def drain(self, timeout_seconds: float):
+        """Wait for queued writes to finish, then stop the writer"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout_seconds)
+        except asyncio.TimeoutError:
+            logger.warning(f"Mem0 write queue not drained after {timeout_seconds}s, storing the rest locally")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
         
-        # Generate response using Groq
-        # Using llama-3.1-8b-instant model for faster responses
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",  # Using llama-3.1-8b-instant model
+        # Spill queued turns and any batch the cancellation interrupted mid-retry
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        with self._unwritten_lock:
+            unwritten, self._unwritten = self._unwritten, {}
+        for username, messages in unwritten.items():
+            await self._spill(username, messages)
+        await asyncio.gather(*self._overflow)
+    
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            # Coalesce each user's turns (in order) into one add call
+            by_user: Dict[str, List[Dict]] = {}
+            for username, messages in batch:
+                by_user.setdefault(username, []).extend(messages)
+            try:
+                results = await asyncio.gather(
+                    *(self._write(username, messages) for username, messages in by_user.items()),
+                    return_exceptions=True
+                )
+                # One user's failure must not stop the writer for everyone else
+                for username, result in zip(by_user, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Mem0 write-behind failed for {username}: {str(result)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    async def _spill(self, username: str, messages: List[Dict]):
+        """Store turns in the SQLite fallback from a worker thread"""
+        try:
+            await asyncio.to_thread(_spill_to_sqlite, username, messages)
+            self._stats["spilled"] += len(messages)
+        except Exception as e:
+            logger.error(f"Error storing {len(messages)} messages locally for {username}, dropping them: {str(e)}")
+    
+    def _settle(self, username: str, count: int):
+        """Stop tracking the user's oldest `count` turns once they are written or spilled"""
+        with self._unwritten_lock:
+            remaining = self._unwritten.get(username)
+            if remaining is not None:
+                del remaining[:count]
+                if not remaining:
+                    del self._unwritten[username]
+    
+    async def _write(self, username: str, messages: List[Dict]):
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    await asyncio.to_thread(_write_to_mem0, username, messages)
+                    self._stats["calls"] += 1
+                    self._stats["written"] += len(messages)
+                    self._settle(username, len(messages))
+                    return
+                except Exception as e:
+                    if attempt == self.retries:
+                        logger.error(f"Error adding messages to Mem0 for {username}, storing locally: {str(e)}")
+                        break
+                    self._stats["retries"] += 1
+                    await asyncio.sleep(self.backoff_seconds * 2 ** attempt)
+            
+            await self._spill(username, messages)
+            self._settle(username, len(messages))
+
+mem0_writer = Mem0WriteBehind(
+    queue_size=MEM0_WRITE_QUEUE_SIZE,
+    batch_size=MEM0_WRITE_BATCH,
+    concurrency=MEM0_WRITE_CONCURRENCY,
+    retries=MEM0_WRITE_RETRIES,
+    backoff_seconds=MEM0_WRITE_BACKOFF_SECONDS
+)
+
+def _parse_memory_turn(item) -> Optional[Dict]:
+    """A Mem0 item as {"id", "message", "is_user", "timestamp", "is_summary"}, or None"""
+    if not isinstance(item, dict) or "memory" not in item:
+        return None
+    content, role = item["memory"], "assistant"
+    try:
+        memory_data = json.loads(content)
+        if isinstance(memory_data, dict):
+            role = memory_data.get("role", role)
+            content = memory_data.get("content", content)
+    except (TypeError, ValueError):
+        pass
+    return {
+        "id": item.get("id"),
+        "message": content,
+        "is_user": role == "user",
+        "timestamp": item.get("created_at"),
+        "is_summary": (item.get("metadata") or {}).get("kind") == "summary",
+    }
+
+def compact_mem0_user(username: str) -> bool:
+    """Fold a user's old Mem0 turns into one rolling summary; True if anything was folded"""
+    items = mem0_client.get_all(
+        filters={"user_id": username},
+        version="v2",
+        limit=MEM0_COMPACT_AFTER * 2
+    )
+    memories = [turn for turn in map(_parse_memory_turn, items or []) if turn and turn["id"]]
+    memories.sort(key=lambda turn: turn["timestamp"] or "")
+    summaries = [turn for turn in memories if turn["is_summary"]]
+    turns = [turn for turn in memories if not turn["is_summary"]]
+    if len(turns) <= MEM0_COMPACT_AFTER:
+        return False
+    
+    folded = turns[:len(turns) - MEM0_COMPACT_KEEP_RECENT]
+    previous = summaries[-1]["message"] if summaries else None
+    response = groq_client.chat.completions.create(
+        model="llama-3.1-8b-instant",
+        messages=[{"role": "user", "content": build_summary_prompt(folded, previous)}],
+        max_tokens=400,
+        temperature=0.2,
+    )
+    summary = response.choices[0].message.content.strip()
+    if not summary:
+        return False
+    
+    # Archive the raw turns locally before they leave Mem0
+    conn = sqlite3.connect("data/memory.db")
+    conn.executemany(
+        "INSERT INTO messages (username, message, is_user, timestamp) VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+        [(username, turn["message"], turn["is_user"], turn["timestamp"]) for turn in folded]
+    )
+    conn.commit()
+    conn.close()
+    
+    mem0_client.add(
+        messages=[{"role": "assistant", "content": summary}],
+        user_id=username,
+        version="v2",
+        metadata={"kind": "summary"},
+        store_raw=True
+    )
+    for turn in folded + summaries:
+        mem0_client.delete(memory_id=turn["id"])
+    
+    # The buffer still holds the folded turns; re-seed it from the compacted Mem0 history
+    context_buffers.discard(username)
+    logger.info(f"Compacted {len(folded)} Mem0 memories for user {username}")
+    return True
+
+async def mem0_compaction_loop():
+    """Periodically compact users who chatted since the last pass, one LLM call at a time"""
+    while True:
+        await asyncio.sleep(MEM0_COMPACT_INTERVAL_SECONDS)
+        usernames = list(compaction_candidates)
+        compaction_candidates.clear()
+        for username in usernames:
+            # Stay out of the way of interactive traffic
+            while time.monotonic() - last_activity < MEM0_COMPACT_IDLE_SECONDS:
+                await asyncio.sleep(MEM0_COMPACT_IDLE_SECONDS)
+            try:
+                if await asyncio.to_thread(compact_mem0_user, username):
+                    await asyncio.sleep(MEM0_COMPACT_MIN_GAP_SECONDS)
+            except Exception as e:
+                logger.error(f"Error compacting Mem0 history for {username}: {str(e)}")
+                # Try again on the next pass
+                compaction_candidates.add(username)
+
+@app.on_event("startup")
+async def start_mem0_compaction():
+    if MEM0_COMPACT_AFTER:
+        asyncio.create_task(mem0_compaction_loop())
+
+@app.on_event("startup")
+async def start_mem0_writer():
+    mem0_writer.start()
+
+@app.on_event("shutdown")
+async def drain_mem0_writer():
+    await mem0_writer.drain(MEM0_WRITE_DRAIN_SECONDS)
+
+@app.on_event("shutdown")
+async def close_groq_client():
+    await async_groq_client.close()
+
+async def groq_chat(messages: List[Dict], max_tokens: int = 1024, temperature: float = 0.7) -> str:
+    """One chat completion on the shared async client, at most GROQ_MAX_CONCURRENCY at a time"""
+    async with groq_semaphore:
+        response = await async_groq_client.chat.completions.create(
+            model="llama-3.1-8b-instant",
             messages=messages,
-            max_tokens=1024,
-            temperature=0.7,
+            max_tokens=max_tokens,
+            temperature=temperature,
         )
+    return response.choices[0].message.content
+
+async def groq_chat_stream(messages: List[Dict], max_tokens: int = 1024, temperature: float = 0.7) -> AsyncIterator[str]:
+    """Streamed chat completion yielding text deltas; holds a concurrency slot until done"""
+    async with groq_semaphore:
+        stream = await async_groq_client.chat.completions.create(
+            model="llama-3.1-8b-instant",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+def _error_reply(error: Exception) -> str:
+    """User-facing text for a failed generation"""
+    logger.error(f"Error generating response: {str(error)}")
+    # Check if this is a rate limit error
+    if "429" in str(error) and "quota" in str(error).lower():
+        return "I'm sorry, the AI service is currently experiencing high demand. Please try again in a moment."
+    return "I'm sorry, I encountered an error processing your request."
+
+def build_chat_messages(
+    message: str, username: str, agent_name: str = "general-assistant", session: Optional[MemorySession] = None
+) -> List[Dict]:
+    """System prompt, the user's history packed to the agent's budget, then the current message"""
+    # Get agent profile
+    agent = AGENTS.get(agent_name, AGENTS["general-assistant"])
+    
+    # We'll prepare messages directly in the format Groq expects
+    messages = [
+        {"role": "system", "content": agent['prompt']}
+    ]
+    
+    # Keep as much of the user's history as fits the agent's token budget. Turns not yet
+    # in Mem0 are the latest exchange: picked newest first, they go first into the budget
+    session = session or MemorySession(username)
+    recent = pack_by_budget(
+        ((item, count_tokens(item["content"])) for item in reversed(session.recent())),
+        agent["context_tokens"]
+    )
+    remaining = agent["context_tokens"] - sum(count_tokens(item["content"]) + LINE_OVERHEAD_TOKENS for item in recent)
+    messages.extend(pack_by_budget(
+        ((item, count_tokens(item["content"])) for item in session.history()),
+        remaining
+    ))
+    # ...but reach the model in conversation order, right before the current message
+    messages.extend(reversed(recent))
+    
+    # Always add the current message at the end
+    messages.append({"role": "user", "content": message})
+    return messages
+
+async def generate_response(
+    message: str,
+    username: str,
+    agent_name: str = "general-assistant",
+    context: Optional[str] = None,
+    session: Optional[MemorySession] = None
+) -> str:
+    try:
+        messages = await asyncio.to_thread(build_chat_messages, message, username, agent_name, session)
         
-        # Extract the response text
-        response_text = response.choices[0].message.content
-        
-        return response_text
+        # Generate response using Groq (llama-3.1-8b-instant for faster responses)
+        return await groq_chat(messages, max_tokens=1024, temperature=0.7)
     except Exception as e:
-        logger.error(f"Error generating response: {str(e)}")
-        # Check if this is a rate limit error
-        if "429" in str(e) and "quota" in str(e).lower():
-            return "I'm sorry, the AI service is currently experiencing high demand. Please try again in a moment."
-        return "I'm sorry, I encountered an error processing your request."
+        return _error_reply(e)
+
+async def stream_response(
+    message: str, username: str, agent_name: str = "general-assistant", session: Optional[MemorySession] = None
+) -> AsyncIterator[str]:
+    """Like generate_response, but yields the reply as it is generated"""
+    streamed = False
+    try:
+        messages = await asyncio.to_thread(build_chat_messages, message, username, agent_name, session)
+        async for delta in groq_chat_stream(messages, max_tokens=1024, temperature=0.7):
+            streamed = True
+            yield delta
+    except Exception as e:
+        if streamed:
+            # Keep the partial reply rather than splicing an apology into it
+            logger.error(f"Response stream for {username} ended early: {str(e)}")
+        else:
+            yield _error_reply(e)
+
+async def stream_reply_to_room(
+    room_name: str, message: str, username: str, agent_name: str, session: Optional[MemorySession] = None
+) -> str:
+    """
+    Stream a reply to every room member as "delta" frames, then send the full
+    text as a "message" frame with the same id. Returns the full text.
+    """
+    reply_id = uuid.uuid4().hex
+    parts = []
+    async for delta in stream_response(message, username, agent_name, session):
+        parts.append(delta)
+        await broadcast_to_room(room_name, {
+            "type": "delta",
+            "id": reply_id,
+            "sender": "ai-assistant",
+            "content": delta,
+            "username": username
+        })
+    
+    response = "".join(parts)
+    await broadcast_to_room(room_name, {
+        "type": "message",
+        "id": reply_id,
+        "sender": "ai-assistant",
+        "content": response,
+        "username": username
+    })
+    return response
 
 @app.get("/")
 async def root():
@@ -422,7 +1022,7 @@ async def create_room(request: RoomRequest):
         room_name = request.room_name
         
         # Initialize user if they don't exist
-        initialize_user(username)
+        await asyncio.to_thread(initialize_user, username)
         
         # In a real LiveKit implementation, we would create a token here
         # For this simplified version, we'll just return a dummy token
@@ -440,24 +1040,48 @@ async def get_agent_response(request: MessageRequest):
         message = request.message
         agent_name = request.agent
         
-        # Initialize user if they don't exist
-        initialize_user(username)
-        
-        # Get context from memory
-        context = get_context_for_user(username)
-        
-        # Generate response
-        response = await generate_response(message, username, agent_name, context)
+        # One Mem0 search feeds the prompt; the turn is written in one call,
+        # which also establishes a new user
+        session = MemorySession(username)
+        response = await generate_response(message, username, agent_name, session=session)
         
         # Store the message and response
-        add_message(username, message, True)
-        add_message(username, response, False)
+        session.add(message, True)
+        session.add(response, False)
+        session.commit_later()
         
         return {"response": response, "agent": agent_name}
     except Exception as e:
         logger.error(f"Error generating agent response: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/agent-response/stream")
+async def stream_agent_response(request: MessageRequest):
+    """Server-sent events variant of /agent-response: "delta" events, then one "done" event"""
+    username = request.username
+    message = request.message
+    agent_name = request.agent
+    session = MemorySession(username)
+    
+    async def events():
+        parts = []
+        async for delta in stream_response(message, username, agent_name, session):
+            parts.append(delta)
+            yield f"event: delta\ndata: {json.dumps({'content': delta})}\n\n"
+        
+        # Persist once the whole reply is known
+        response = "".join(parts)
+        session.add(message, True)
+        session.add(response, False)
+        session.commit_later()
+        yield f"event: done\ndata: {json.dumps({'response': response, 'agent': agent_name})}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/handoff")
 async def handoff_conversation(request: HandoffRequest):
     """Handoff a conversation from one agent to another"""
@@ -472,7 +1096,8 @@ async def handoff_conversation(request: HandoffRequest):
         logger.info(f"Agent found: {agent}")
         
         # Get conversation context from memory
-        context = get_context_for_user(username, limit=15)
+        session = MemorySession(username)
+        context = await asyncio.to_thread(session.context, agent["context_tokens"])
         
         # Generate contextual handoff message using the new agent
         handoff_prompt = f"""
@@ -492,12 +1117,14 @@ async def handoff_conversation(request: HandoffRequest):
             message=handoff_prompt, 
             username=username, 
             agent_name=to_agent,
-            context=None  # Don't add extra context since we already have it in the prompt
+            context=None,  # Don't add extra context since we already have it in the prompt
+            session=session
         )
         
         
         # Store the handoff message
-        add_message(username, handoff_response, False)
+        session.add(handoff_response, False)
+        session.commit_later()
         
         return {
             "success": True, 
@@ -559,12 +1186,10 @@ async def websocket_endpoint(websocket: WebSocket, username: str, room_name: str
             room_members[room_name].append(username)
             
         
-        # Initialize user if they don't exist
-        initialize_user(username)
-        
-        # Check if this is a returning user
-        user_messages = get_all_messages_for_user(username)
-        is_returning_user = len(user_messages) > 0
+        # Check if this is a returning user (usually answered locally); the welcome
+        # below is the session's one write and also initializes a new user
+        session = MemorySession(username)
+        is_returning_user = await asyncio.to_thread(session.exists)
         
         # Use a simple welcome message that doesn't reference previous conversations
         if is_returning_user:
@@ -592,7 +1217,8 @@ async def websocket_endpoint(websocket: WebSocket, username: str, room_name: str
         await broadcast_to_room(room_name, welcome_message_obj, exclude_user=None)
         
         # Add welcome message to memory
-        add_message(username, welcome_message, False)
+        session.add(welcome_message, False)
+        session.commit_later()
         
         # Main message loop
         while True:
@@ -610,25 +1236,16 @@ async def websocket_endpoint(websocket: WebSocket, username: str, room_name: str
             # Don't exclude the sender - everyone should see the message
             await broadcast_to_room(room_name, user_message_obj, exclude_user=None)
             
-            # Store the message in memory
-            add_message(username, message, True)
-            
-            # Generate response (context handling is now done inside generate_response)
-            response = await generate_response(message, username, agent_name)
+            # One Mem0 read for the prompt and one write for the whole turn
+            session = MemorySession(username)
             
-            # Store the AI response in memory
-            add_message(username, response, False)
-            
-            # Prepare message object
-            response_message = {
-                "type": "message",
-                "sender": "ai-assistant",
-                "content": response,
-                "username": username  # Include sender's username
-            }
+            # Stream the response to all users in the room (including the sender)
+            response = await stream_reply_to_room(room_name, message, username, agent_name, session)
             
-            # Send response to all users in the room (including the sender)
-            await broadcast_to_room(room_name, response_message, exclude_user=None)
+            # Store the message and the complete AI response in memory
+            session.add(message, True)
+            session.add(response, False)
+            session.commit_later()
             
     except WebSocketDisconnect:
         logger.info(f"User {username} disconnected from room {room_name}")
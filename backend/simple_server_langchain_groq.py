@@ -13,6 +13,8 @@ from langchain_core.messages import SystemMessage, HumanMessage
 from dotenv import load_dotenv
 from mem0 import MemoryClient
 
+from app.memory.token_counter import count_tokens, pack_by_budget
+
 # Load environment variables
 load_dotenv()
 
@@ -100,37 +102,45 @@ class HandoffRequest(BaseModel):
     to_agent: str
     reason: str = ""
 
+# Memories fetched per search; the agent's token budget decides how many reach the prompt
+CONTEXT_SEARCH_LIMIT = 20
+
 # Agent profiles
 AGENTS = {
     "general-assistant": {
         "name": "General Assistant",
         "role": "General Assistant",
         "description": "A helpful, concise assistant providing clear answers",
-        "prompt": "You are a helpful, concise assistant. Provide clear answers, step-by-step instructions when useful, and ask one clarifying question if the request is ambiguous. Keep responses under ~300 words unless the user asks for more."
+        "prompt": "You are a helpful, concise assistant. Provide clear answers, step-by-step instructions when useful, and ask one clarifying question if the request is ambiguous. Keep responses under ~300 words unless the user asks for more.",
+        "context_tokens": 768
     },
     "technical-assistant": {
         "name": "Technical Assistant",
         "role": "Developer Assistant",
         "description": "Expert developer assistant providing code examples and technical advice",
-        "prompt": "You are an expert developer assistant. Prioritize correct code examples, minimal reproducible snippets, and explain trade-offs. When giving commands, mark them in code blocks. Ask for environment details (OS, language version, frameworks) if missing."
+        "prompt": "You are an expert developer assistant. Prioritize correct code examples, minimal reproducible snippets, and explain trade-offs. When giving commands, mark them in code blocks. Ask for environment details (OS, language version, frameworks) if missing.",
+        "context_tokens": 2048
     },
     "creative-writer": {
         "name": "Creative Writer",
         "role": "Creative Writer",
         "description": "Creative writing assistant producing vivid, original text",
-        "prompt": "You are a creative writing assistant. Produce vivid, original text in the requested tone and length. If the user does not specify tone or POV, ask which they prefer. Avoid clichés and keep language fresh."
+        "prompt": "You are a creative writing assistant. Produce vivid, original text in the requested tone and length. If the user does not specify tone or POV, ask which they prefer. Avoid clichés and keep language fresh.",
+        "context_tokens": 1024
     },
     "fact-checker": {
         "name": "Fact Checker",
         "role": "Research Assistant",
         "description": "Careful fact-checker verifying claims with sources",
-        "prompt": "You are a careful fact-checker. Verify claims, list the confidence level, and provide 2–3 concise sources or suggestions where to look. If unsure, say so explicitly and propose next steps to verify."
+        "prompt": "You are a careful fact-checker. Verify claims, list the confidence level, and provide 2–3 concise sources or suggestions where to look. If unsure, say so explicitly and propose next steps to verify.",
+        "context_tokens": 1024
     },
     "tutor": {
         "name": "Tutor",
         "role": "Educational Assistant",
         "description": "Patient tutor explaining concepts with examples",
-        "prompt": "You are a patient tutor. Explain concepts step-by-step, use simple analogies, give a single short example, and then offer a small practice problem the user can try. Ask if they'd like a deeper dive."
+        "prompt": "You are a patient tutor. Explain concepts step-by-step, use simple analogies, give a single short example, and then offer a small practice problem the user can try. Ask if they'd like a deeper dive.",
+        "context_tokens": 1024
     }
 }
 
@@ -248,8 +258,8 @@ def get_all_messages_for_user(username: str) -> list:
         
         return messages
 
-def get_context_for_user(username: str, limit: int = 10) -> str:
-    """Get context for a user from Mem0"""
+def get_context_for_user(username: str, token_budget: int = 1024, limit: int = CONTEXT_SEARCH_LIMIT) -> str:
+    """Get context for a user from Mem0, packed into `token_budget` tokens"""
     try:
         # Using v2 search API to get relevant context
         filters = {"user_id": username}
@@ -263,8 +273,8 @@ def get_context_for_user(username: str, limit: int = 10) -> str:
             limit=limit
         )
         
-        # Format the context
-        context = ""
+        # Format the context, most relevant memories first
+        lines = []
         if results:
             for item in results:
                 # Extract memory content
@@ -278,14 +288,14 @@ def get_context_for_user(username: str, limit: int = 10) -> str:
                             role = memory_data.get("role", "unknown")
                             content = memory_data.get("content", memory_content)
                             speaker = "User" if role == "user" else "Assistant"
-                            context += f"{speaker}: {content}\n"
+                            lines.append(f"{speaker}: {content}\n")
                         else:
-                            context += f"{memory_content}\n"
+                            lines.append(f"{memory_content}\n")
                     except:
                         # If parsing fails, just use the raw memory
-                        context += f"{memory_content}\n"
+                        lines.append(f"{memory_content}\n")
         
-        return context
+        return "".join(pack_by_budget(((line, count_tokens(line)) for line in lines), token_budget))
     except Exception as e:
         logger.error(f"Error getting context from Mem0: {str(e)}")
         # Fall back to SQLite
@@ -298,13 +308,14 @@ def get_context_for_user(username: str, limit: int = 10) -> str:
         messages = cursor.fetchall()
         conn.close()
         
-        # Format the context
-        context = ""
-        for message, is_user in reversed(messages):
+        # Keep the newest messages that fit, then restore chronological order
+        lines = []
+        for message, is_user in messages:
             speaker = "User" if is_user else "Assistant"
-            context += f"{speaker}: {message}\n"
+            lines.append(f"{speaker}: {message}\n")
+        packed = pack_by_budget(((line, count_tokens(line)) for line in lines), token_budget)
         
-        return context
+        return "".join(reversed(packed))
 
 async def generate_response(message: str, username: str, agent_name: str = "general-assistant", context: Optional[str] = None) -> str:
     try:
@@ -331,10 +342,11 @@ async def generate_response(message: str, username: str, agent_name: str = "gene
                     query="recent conversation",
                     version="v2",
                     filters=filters,
-                    limit=10  # Limit to recent messages
+                    limit=CONTEXT_SEARCH_LIMIT
                 )
                 
-                # Format messages for LangChain
+                # Format messages for LangChain, most relevant first
+                history = []
                 if recent_messages:
                     for item in recent_messages:
                         # Extract memory content
@@ -350,12 +362,18 @@ async def generate_response(message: str, username: str, agent_name: str = "gene
                                     
                                     # Add as the appropriate message type
                                     if role == "user" and content:
-                                        messages.append(HumanMessage(content=content))
+                                        history.append(HumanMessage(content=content))
                                     elif role == "assistant" and content:
-                                        messages.append(SystemMessage(content=content))
+                                        history.append(SystemMessage(content=content))
                             except:
                                 # Skip invalid memories
                                 pass
+                
+                # Keep as much history as fits the agent's token budget
+                messages.extend(pack_by_budget(
+                    ((item, count_tokens(item.content)) for item in history),
+                    agent["context_tokens"]
+                ))
             except Exception as mem_err:
                 logger.warning(f"Error retrieving memory context: {str(mem_err)}")
         
@@ -72,21 +72,53 @@ export default function ChatPage() {
 
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      
+
+      if (data.type === "delta") {
+        // Streamed reply: grow the message with this id as tokens arrive
+        setMessages((prev) => {
+          const index = prev.findIndex((message) => message.id === data.id);
+          if (index === -1) {
+            return [
+              ...prev,
+              {
+                id: data.id,
+                content: data.content,
+                sender: data.sender,
+                timestamp: new Date(),
+                username: data.username,
+                isUser: false
+              },
+            ];
+          }
+          const updated = [...prev];
+          updated[index] = { ...updated[index], content: updated[index].content + data.content };
+          return updated;
+        });
+        setIsGenerating(false);
+        return;
+      }
+
       if (data.type === "message" || data.type === "system") {
-        setMessages((prev) => [
-          ...prev,
-          {
-            id: Date.now().toString(),
-            content: data.content,
-            sender: data.sender,
-            timestamp: new Date(),
-            username: data.username,
-            isSystem: data.type === "system",
-            // Server now sends isUser flag to tell if this is the current user's message
-            isUser: !!data.isUser
-          },
-        ]);
+        const message: Message = {
+          id: data.id || Date.now().toString(),
+          content: data.content,
+          sender: data.sender,
+          timestamp: new Date(),
+          username: data.username,
+          isSystem: data.type === "system",
+          // Server now sends isUser flag to tell if this is the current user's message
+          isUser: !!data.isUser
+        };
+        setMessages((prev) => {
+          // The final frame of a streamed reply replaces the accumulated deltas
+          const index = data.id ? prev.findIndex((existing) => existing.id === data.id) : -1;
+          if (index === -1) {
+            return [...prev, message];
+          }
+          const updated = [...prev];
+          updated[index] = { ...message, timestamp: updated[index].timestamp };
+          return updated;
+        });
         
         // Clear generating state when we receive a response (not from user)
         if (data.type === "message" && !data.isUser) {